@@ -4,20 +4,28 @@ Telegram-бот для HR-отдела компании "Мечел"
 Версия 15.7 – полная интеграция с SearchEngine v5.6 (FAQEntry dataclass)
 """
 import os
+import re
 import sys
 import asyncio
+import atexit
 import logging
+import logging.handlers
+import queue
 import time
 import hashlib
 import signal
+import hmac
 import json
+try:
+    import fcntl
+except ImportError:  # Windows: один процесс, блокировка не нужна
+    fcntl = None
 import functools
+from collections import Counter
 from datetime import datetime, timedelta
 from typing import List, Optional, Union, Tuple, Any, Dict
-from quart import Quart, request, jsonify
-import hypercorn
-from hypercorn.config import Config
-from hypercorn.asyncio import serve
+from quart import Quart, Response, request, jsonify
+from quart.json.provider import DefaultJSONProvider
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -26,7 +34,8 @@ from telegram.ext import (
     CallbackQueryHandler,
     filters,
     ContextTypes,
-    ApplicationBuilder
+    ApplicationBuilder,
+    SimpleUpdateProcessor
 )
 from dotenv import load_dotenv
 from cachetools import TTLCache
@@ -34,7 +43,7 @@ from cachetools import TTLCache
 # Импорты наших модулей
 from database import (
     init_db, shutdown_db, get_pool,
-    get_subscribers, add_subscriber, remove_subscriber, ensure_subscribed,
+    get_subscribers, count_subscribers, add_subscriber, remove_subscriber, ensure_subscribed,
     get_message, save_message, load_all_messages,
     load_all_faq,
     add_meme_history, get_meme_count_last_24h,
@@ -42,14 +51,14 @@ from database import (
     save_feedback,
     save_rating,
     log_error,
-    cleanup_old_errors,
-    cleanup_old_feedback,
+    cleanup_old_data,
     get_total_rows_count,
     set_db_available,
-    is_db_available
+    is_db_available,
+    get_db_health
 )
-from stats import BotStatistics, generate_excel_report
-from utils import is_greeting, truncate_question, parse_period_argument
+from stats import BotStatistics, generate_excel_report, run_report, shutdown_report_executor
+from utils import is_greeting, truncate_question, parse_period_argument, now_iso
 from web_panel import register_web_routes
 
 # Модуль мемов
@@ -74,6 +83,19 @@ except ImportError:
     async def meme_unsubscribe_command(*args, **kwargs): pass
     def get_meme_handler(): return None
 
+# Быстрый разбор и сериализация JSON (orjson), при отсутствии пакета – стандартный json
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+    print("✅ orjson загружен")
+except ImportError:
+    orjson = None
+    _json_loads = json.loads
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    print("⚠️ orjson не найден, для вебхука используется стандартный json")
+
 # ✅ ПОИСКОВЫЙ ДВИЖОК – используем SearchEngine из search_engine.py
 # ✅ ИСПРАВЛЕНО: print() вместо logger.info() – логгер ещё не инициализирован
 try:
@@ -108,6 +130,45 @@ FALLBACK_FAQ = [
     {"id": 15, "question": "Куда сообщить о проблеме с ботом?", "answer": "Напишите /feedback — мы обязательно рассмотрим ваше сообщение при восстановлении работы системы.", "category": "Обратная связь"}
 ]
 
+# ------------------------------------------------------------
+#  ЛОГИРОВАНИЕ
+# ------------------------------------------------------------
+# Настраивается до первого logging.*-вызова ниже, иначе basicConfig станет no-op.
+# Обработчики только кладут запись в очередь, запись в stdout идёт в фоновом потоке
+# QueueListener – обработчики Telegram не ждут ввода-вывода. Файловых логов нет:
+# диск Render эфемерный, логи собираются из stdout.
+# LOG_PLAIN=true убирает эмодзи из строк лога (по умолчанию логи остаются как есть)
+_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+_LOG_EMOJI_RE = re.compile('[\U0001F000-\U0001FAFF\u2300-\u23FF\u2600-\u27BF\u2B00-\u2BFF\uFE0F]+ ?')
+
+
+class _PlainFormatter(logging.Formatter):
+    """Форматтер без эмодзи: строки лога сводятся к ASCII/кириллице."""
+
+    def format(self, record):
+        return _LOG_EMOJI_RE.sub('', super().format(record))
+
+
+_log_queue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler(sys.stdout)
+_log_stream_handler.setFormatter(
+    _PlainFormatter(_LOG_FORMAT) if os.getenv('LOG_PLAIN', 'false').lower() == 'true'
+    else logging.Formatter(_LOG_FORMAT)
+)
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler, respect_handler_level=True)
+# QueueHandler.prepare() записывает отформатированный текст в record.msg, поэтому его
+# форматтер – только '%(message)s': префикс времени и уровня добавляет _log_stream_handler
+logging.basicConfig(
+    level=getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO),
+    format='%(message)s',
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
+)
+# httpx пишет INFO-строку на каждый запрос к Bot API (с токеном в URL) – оставляем только предупреждения
+logging.getLogger('httpx').setLevel(logging.WARNING)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger = logging.getLogger(__name__)
+
 # ------------------------------------------------------------
 #  КОНФИГУРАЦИЯ
 # ------------------------------------------------------------
@@ -139,13 +200,39 @@ if not WEBHOOK_SECRET:
     if RENDER:
         logging.warning("⚠️ WEBHOOK_SECRET сгенерирован автоматически")
 
+# При нескольких воркерах hypercorn задачи «одна на сервис» (вебхук, рассылки по расписанию,
+# очистка БД) выполняет только воркер, захвативший файловую блокировку
+PRIMARY_LOCK_PATH = os.getenv('PRIMARY_LOCK_PATH', '/tmp/hr-bot-mechel.lock')
+_primary_lock_fd: Optional[int] = None
+
+def _acquire_primary_lock() -> bool:
+    """Пытается стать основным воркером; блокировка держится до завершения процесса."""
+    global _primary_lock_fd
+    if _primary_lock_fd is not None:
+        return True
+    if fcntl is None:
+        return True
+    fd = os.open(PRIMARY_LOCK_PATH, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    _primary_lock_fd = fd
+    return True
+
 WEBHOOK_PATH = f"/webhook/{WEBHOOK_SECRET}"
+# Байтовая форма секрета для сравнения за постоянное время в вебхуке
+_WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode()
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
 if RENDER and not WEBHOOK_URL:
     logging.critical("❌ На Render WEBHOOK_URL обязателен")
     sys.exit(1)
 
-BASE_URL = f"http://localhost:{PORT}" if not RENDER else WEBHOOK_URL.rstrip('/')
+BASE_URL = WEBHOOK_URL.rstrip('/') if WEBHOOK_URL else f"http://localhost:{PORT}"
+
+# Вебхук используется всегда, когда задан публичный URL (не только на Render)
+USE_WEBHOOK = bool(WEBHOOK_URL)
 
 ADMIN_IDS = []
 try:
@@ -165,37 +252,116 @@ EXIT_ON_DB_FAILURE = os.getenv('EXIT_ON_DB_FAILURE', 'false').lower() == 'true'
 # ------------------------------------------------------------
 app = Quart(__name__)
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON-провайдер Quart на orjson: jsonify во всех эндпоинтах сериализует без stdlib json."""
+    # Даты и прочие нестандартные типы по-прежнему проходят через default провайдера Quart
+    _OPTIONS = (orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                if orjson else 0)
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default, option=self._OPTIONS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+# /ping для внешних мониторингов отвечается на уровне ASGI, до маршрутизации и контекста запроса Quart
+_PING_BODY = b'pong'
+_PING_START = {
+    'type': 'http.response.start',
+    'status': 200,
+    'headers': [(b'content-type', b'text/plain'), (b'content-length', str(len(_PING_BODY)).encode())],
+}
+_PING_RESPONSE = {'type': 'http.response.body', 'body': _PING_BODY}
+_PING_HEAD_RESPONSE = {'type': 'http.response.body', 'body': b''}
+_PING_NOT_ALLOWED_START = {
+    'type': 'http.response.start',
+    'status': 405,
+    'headers': [(b'allow', b'GET, HEAD'), (b'content-length', b'0')],
+}
+
+class _PingMiddleware:
+    def __init__(self, asgi_app):
+        self.asgi_app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == '/ping':
+            method = scope['method']
+            if method == 'GET':
+                await send(_PING_START)
+                await send(_PING_RESPONSE)
+            elif method == 'HEAD':
+                await send(_PING_START)
+                await send(_PING_HEAD_RESPONSE)
+            else:
+                await send(_PING_NOT_ALLOWED_START)
+                await send(_PING_HEAD_RESPONSE)
+            return
+        await self.asgi_app(scope, receive, send)
+
+app.asgi_app = _PingMiddleware(app.asgi_app)
+
 # Глобальные объекты
 application: Optional[Application] = None
 search_engine: Optional[Union['SearchEngine', 'BuiltinSearchEngine']] = None
 bot_stats: Optional[BotStatistics] = None
 
-# ✅ ИСПРАВЛЕНО: Добавлена переменная _cleanup_task
-_cleanup_task: Optional[asyncio.Task] = None
-
 # Флаги инициализации
 _bot_initialized = False
 _bot_initializing = False
 _bot_init_lock = asyncio.Lock()
+# Сигнал готовности бота: вебхуки, пришедшие во время инициализации, ждут его,
+# а не опрашивают флаг в цикле со sleep
+_bot_ready = asyncio.Event()
 _routes_registered = False
 _bot_initialization_task: Optional[asyncio.Task] = None
 
+# Типы обновлений, для которых зарегистрированы обработчики (Message/Command/CallbackQuery).
+# Остальные отбрасываются в вебхуке до разбора в объект Update
+HANDLED_UPDATE_TYPES = frozenset({'message', 'edited_message', 'callback_query'})
+# Те же типы передаются в setWebhook: остальные Telegram не присылает вовсе
+WEBHOOK_ALLOWED_UPDATES = sorted(HANDLED_UPDATE_TYPES)
+
+# Верхняя граница тела вебхука: обновления Telegram с текстом укладываются в десятки КБ
+MAX_WEBHOOK_BODY = 1_000_000
+
+# Обработчики, выполняющиеся одновременно (значение PTB для concurrent_updates(True))
+MAX_CONCURRENT_UPDATES = 256
+# Предел принятых, но ещё не обработанных обновлений: при concurrent_updates PTB сразу
+# забирает обновление из update_queue и создаёт задачу, так что очередь не растёт –
+# копятся задачи. Сверх предела вебхук отвечает 503, и Telegram повторит доставку
+MAX_PENDING_UPDATES = 1000
+
+
+class _CountingUpdateProcessor(SimpleUpdateProcessor):
+    """
+    Параллельная обработка обновлений со счётчиком незавершённых.
+    pending увеличивает вебхук перед put_nowait, уменьшает process_update по завершении;
+    счётчик живёт в экземпляре, поэтому новое Application начинает с нуля.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.pending = 0
+
+    async def process_update(self, update, coroutine) -> None:
+        try:
+            await super().process_update(update, coroutine)
+        finally:
+            self.pending -= 1
+
 # Кэш подписок
 user_subscribed_cache = TTLCache(maxsize=10000, ttl=7200)
+# Незавершённые записи подписки: user_id -> задача ensure_subscribed
+_subscribe_inflight: Dict[int, asyncio.Task] = {}
 
 # Глобальный флаг резервного режима
 fallback_mode = False
 
-# ------------------------------------------------------------
-#  ЛОГИРОВАНИЕ
-# ------------------------------------------------------------
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
-logger = logging.getLogger(__name__)
-
 # ------------------------------------------------------------
 #  ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ – УНИВЕРСАЛЬНЫЙ ДОСТУП К FAQ
 # ------------------------------------------------------------
@@ -260,9 +426,17 @@ async def _reply_or_edit(update: Update, text: str, parse_mode: str = 'HTML', re
         return None
 
 async def ensure_subscribed_cached(user_id: int):
+    # Быстрый путь: пользователь уже в кэше – ни БД, ни ожиданий
     if user_id in user_subscribed_cache:
         return
-    await ensure_subscribed(user_id)
+    # Медленный путь: при concurrent_updates несколько обновлений одного пользователя
+    # ждут одну общую запись в БД вместо параллельных INSERT
+    task = _subscribe_inflight.get(user_id)
+    if task is None:
+        task = asyncio.ensure_future(ensure_subscribed(user_id))
+        _subscribe_inflight[user_id] = task
+        task.add_done_callback(lambda _t: _subscribe_inflight.pop(user_id, None))
+    await asyncio.shield(task)
     user_subscribed_cache[user_id] = True
 
 def load_faq_from_backup() -> List[Dict]:
@@ -270,7 +444,7 @@ def load_faq_from_backup() -> List[Dict]:
         try:
             with open('faq_backup.json', 'r', encoding='utf-8') as f:
                 data = json.load(f)
-                logger.info(f"✅ Загружено {len(data)} записей из резервной копии faq_backup.json")
+                logger.info("✅ Загружено %s записей из резервной копии faq_backup.json", len(data))
                 return data
         except Exception as e:
             logger.error(f"❌ Ошибка чтения бэкапа FAQ: {e}")
@@ -278,18 +452,19 @@ def load_faq_from_backup() -> List[Dict]:
     return []
 
 # ------------------------------------------------------------
-#  ✅ ИСПРАВЛЕНО: ПЕРИОДИЧЕСКАЯ ОЧИСТКА (ДОБАВЛЕНА ФУНКЦИЯ)
+#  ПЕРИОДИЧЕСКАЯ ОЧИСТКА (задача JobQueue)
 # ------------------------------------------------------------
-async def periodic_cleanup_tasks():
-    while True:
-        try:
-            await asyncio.sleep(3600)
-            if not fallback_mode:
-                await cleanup_old_errors(days=30)
-                await cleanup_old_feedback(days=90)
-                logger.info("🧹 Периодическая очистка выполнена")
-        except Exception as e:
-            logger.error(f"❌ Ошибка периодической очистки: {e}")
+CLEANUP_INTERVAL = 3600  # секунд
+
+async def periodic_cleanup_job(context: ContextTypes.DEFAULT_TYPE):
+    """Раз в час удаляет старые ошибки и отзывы. Выполняется планировщиком JobQueue."""
+    if fallback_mode:
+        return
+    try:
+        await cleanup_old_data(errors_days=30, feedback_days=90)
+        logger.info("🧹 Периодическая очистка выполнена")
+    except Exception as e:
+        logger.error(f"❌ Ошибка периодической очистки: {e}")
 
 # ------------------------------------------------------------
 #  ВСТРОЕННЫЙ ПОИСКОВЫЙ ДВИЖОК (резервный)
@@ -314,7 +489,13 @@ class BuiltinSearchEngine:
         self.suggest_cache = {}
         self.suggest_cache_ttl = timedelta(minutes=30)
         self.max_cache_size = max_cache_size
-        logger.info(f"✅ BuiltinSearchEngine инициализирован с {len(self._faq_data)} записями")
+        self._update_counts()
+        logger.info("✅ BuiltinSearchEngine инициализирован с %s записями", len(self._faq_data))
+
+    def _update_counts(self):
+        """Пересчитывает кэшированные счётчики (вызывается только при смене данных)."""
+        self.category_counts = dict(Counter(_get_faq_category(item) for item in self._faq_data))
+        self.total_faq = len(self._faq_data)
 
     def search(self, query: str, category: str = None, top_k: int = 5) -> List[Tuple[int, str, str, float]]:
         # ✅ ИСПРАВЛЕНО: self.faq_ → self._faq_data
@@ -354,6 +535,7 @@ class BuiltinSearchEngine:
     @faq_data.setter
     def faq_data(self, value):
         self._faq_data = value
+        self._update_counts()
 
 # ------------------------------------------------------------
 #  ДЕКОРАТОР ДЛЯ КОМАНД, ТРЕБУЮЩИХ БД
@@ -373,7 +555,7 @@ def db_required(func):
                 "💡 Просто напишите вопрос — я постараюсь помочь!"
             )
             await _reply_or_edit(update, msg, parse_mode='HTML')
-            logger.debug(f"Отказ в выполнении {cmd} из-за fallback_mode")
+            logger.debug("Отказ в выполнении %s из-за fallback_mode", cmd)
             return
         return await func(update, context)
     return wrapper
@@ -391,8 +573,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await ensure_subscribed_cached(user.id)
         if bot_stats:
+            # 'subscribe' не имеет счётчика: активность уже отмечена записью команды
             await bot_stats.log_message(user.id, user.username or "Unknown", 'command', '/start')
-            await bot_stats.log_message(user.id, user.username or "Unknown", 'subscribe', '')
     except Exception as e:
         logger.error(f"⚠️ Ошибка записи в БД при /start: {e}")
     
@@ -514,7 +696,7 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await _reply_or_edit(update, "📭 Нет подписчиков для рассылки.", parse_mode='HTML')
         return
     delay_before = 3.0 if len(subscribers) > 50 else 1.0
-    logger.info(f"⏳ Пауза {delay_before}с перед рассылкой {len(subscribers)} подписчикам...")
+    logger.info("⏳ Пауза %sс перед рассылкой %s подписчикам...", delay_before, len(subscribers))
     await asyncio.sleep(delay_before)
     sent = 0
     failed = 0
@@ -547,18 +729,13 @@ async def categories_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if search_engine is None:
         await _reply_or_edit(update, "⚠️ Поиск временно не инициализирован.", parse_mode='HTML')
         return
-    faq_data = search_engine.faq_data
-    # ✅ ИСПРАВЛЕНО: if not faq_ → if not faq_data
-    if not faq_data:
+    if not search_engine.total_faq:
         logger.warning("⚠️ categories_command: faq_data пуст!")
         await _reply_or_edit(update, "⚠️ База вопросов пуста. Попробуйте позже.", parse_mode='HTML')
         return
-    logger.info(f"📂 categories_command: faq_data содержит {len(faq_data)} записей")
-    categories = {}
-    # ✅ ИСПРАВЛЕНО: for item in faq_ → for item in faq_data
-    for item in faq_data:
-        cat = _get_faq_category(item)
-        categories[cat] = categories.get(cat, 0) + 1
+    logger.info("📂 categories_command: faq_data содержит %d записей", search_engine.total_faq)
+    # Счётчики по категориям пересчитываются движком только при обновлении FAQ
+    categories = search_engine.category_counts
     if not categories:
         await _reply_or_edit(update, "📂 Категории не найдены.", parse_mode='HTML')
         return
@@ -601,14 +778,15 @@ async def feedbacks_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # ✅ ИСПРАВЛЕНО: generate_feedback_report → generate_excel_report
         subscribers = await get_subscribers() if not fallback_mode else []
-        output = await asyncio.to_thread(generate_excel_report, bot_stats, subscribers, search_engine)
-        filename = f"feedbacks_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        output = await run_report(generate_excel_report, bot_stats, subscribers, search_engine)
+        now_dt = datetime.now()
+        filename = f"feedbacks_{now_dt.strftime('%Y%m%d_%H%M%S')}.xlsx"
         await update.message.reply_document(
             document=output.getvalue(),
             filename=filename,
-            caption=f"📋 Отзывы и предложения от {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+            caption=f"📋 Отзывы и предложения от {now_dt.strftime('%d.%m.%Y %H:%M')}"
         )
-        logger.info(f"✅ Отзывы выгружены пользователем {user.id}")
+        logger.info("✅ Отзывы выгружены пользователем %s", user.id)
     except Exception as e:
         logger.error(f"❌ Ошибка выгрузки отзывов: {e}")
         await _reply_or_edit(update, f"❌ Ошибка: {str(e)}", parse_mode='HTML')
@@ -630,8 +808,8 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         period = parse_period_argument(context.args[0])
     await bot_stats.log_message(user.id, user.username or "Unknown", 'command', f'/stats {period}')
     s = bot_stats.get_summary_stats(period)
-    subscribers = await get_subscribers() if not fallback_mode else []
-    faq_count = len(search_engine.faq_data) if search_engine else 0
+    subscribers_count = await count_subscribers() if not fallback_mode else 0
+    faq_count = search_engine.total_faq if search_engine else 0
     period_names = {
         'all': 'всё время', 'day': 'день', 'week': 'неделя', 'month': 'месяц',
         'quarter': 'квартал', 'halfyear': 'полгода', 'year': 'год'
@@ -657,7 +835,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text += (
         f"📦 Кэш поиска: {s['cache_size']}\n"
         f"⏱ Uptime: {s['uptime']}\n"
-        f"👥 Подписчиков на рассылку: {len(subscribers)}\n"
+        f"👥 Подписчиков на рассылку: {subscribers_count}\n"
         f"📚 Вопросов в базе знаний: {faq_count}\n"
     )
     keyboard = [
@@ -743,14 +921,15 @@ async def export_to_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await bot_stats.log_message(user.id, user.username or "Unknown", 'command', '/export')
     try:
         subscribers = await get_subscribers() if not fallback_mode else []
-        output = await asyncio.to_thread(generate_excel_report, bot_stats, subscribers, search_engine)
-        filename = f"mechel_bot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        output = await run_report(generate_excel_report, bot_stats, subscribers, search_engine)
+        now_dt = datetime.now()
+        filename = f"mechel_bot_{now_dt.strftime('%Y%m%d_%H%M%S')}.xlsx"
         await update.message.reply_document(
             document=output.getvalue(),
             filename=filename,
-            caption=f"📊 Экспорт от {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+            caption=f"📊 Экспорт от {now_dt.strftime('%d.%m.%Y %H:%M')}"
         )
-        logger.info(f"✅ Экспорт выполнен пользователем {user.id}")
+        logger.info("✅ Экспорт выполнен пользователем %s", user.id)
     except Exception as e:
         logger.error(f"❌ Ошибка экспорта: {e}", exc_info=True)
         await _reply_or_edit(update, f"❌ Ошибка: {str(e)}", parse_mode='HTML')
@@ -766,7 +945,7 @@ async def save_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await _reply_or_edit(update, "⛔ Нет прав.", parse_mode='HTML')
         return
     await _reply_or_edit(update, "✅ Данные автоматически сохраняются в Supabase.", parse_mode='HTML')
-    logger.info(f"💾 Запрос /save от пользователя {user.id}")
+    logger.info("💾 Запрос /save от пользователя %s", user.id)
     elapsed = time.time() - start_time
     if bot_stats:
         bot_stats.track_response_time(elapsed)
@@ -803,8 +982,7 @@ async def cleanup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await _reply_or_edit(update, "🧹 Запуск очистки старых данных...", parse_mode='HTML')
     try:
-        await cleanup_old_errors(days=30)
-        await cleanup_old_feedback(days=90)
+        await cleanup_old_data(errors_days=30, feedback_days=90)
         await _reply_or_edit(update, "✅ Очистка завершена успешно!", parse_mode='HTML')
     except Exception as e:
         logger.error(f"❌ Ошибка при очистке: {e}")
@@ -840,7 +1018,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             bot_stats.track_response_time(elapsed)
         return
     if is_greeting(text):
-        logger.info(f"Приветствие от {user.id}: '{text}'")
+        logger.info("Приветствие от %s: '%.50s'", user.id, text)
         greeting_text = await get_message('greeting_response')
         await update.message.reply_text(greeting_text, parse_mode='HTML')
         elapsed = time.time() - start_time
@@ -854,7 +1032,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             bot_stats.track_response_time(elapsed)
         return
     if bot_stats:
-        await bot_stats.log_message(user.id, user.username or "Unknown", 'search')
+        bot_stats.count_event('search')
     if search_engine is None:
         logger.error("❌ handle_message: search_engine = None!")
         await update.message.reply_text(
@@ -877,7 +1055,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if bot_stats:
             bot_stats.track_response_time(elapsed)
         return
-    logger.info(f"🔍 Поиск: user={user.id}, query='{text}', faq_count={len(faq_data)}")
+    logger.info("🔍 Поиск: user=%s, query='%.50s', faq_count=%d", user.id, text, len(faq_data))
     category = None
     search_text = text
     if ':' in text:
@@ -892,12 +1070,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 break
     try:
         results = search_engine.search(search_text, category, top_k=3)
-        logger.info(f"🔍 Поиск по запросу '{search_text}', категория {category}, найдено {len(results)} результатов")
+        logger.info("🔍 Поиск по запросу '%.50s', категория %s, найдено %d результатов", search_text, category, len(results))
     except Exception as e:
         logger.error(f"❌ Ошибка поиска: {e}", exc_info=True)
         results = []
     if not results:
-        logger.warning(f"⚠️ Не найдено результатов для '{text}'")
+        logger.warning("⚠️ Не найдено результатов для '%.50s'", text)
         suggestions = []
         if hasattr(search_engine, 'suggest_correction'):
             suggestions = search_engine.suggest_correction(search_text, top_k=3)
@@ -913,7 +1091,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     for idx, (faq_id, q, a, score) in enumerate(results[:3]):
         if not q or not a:
-            logger.warning(f"⚠️ Пропущен результат {idx}: вопрос или ответ пустые")
+            logger.warning("⚠️ Пропущен результат %s: вопрос или ответ пустые", idx)
             continue
         response = f"📌 <b>Результат {idx+1}:</b>\n• <b>{q}</b>\n{a}"
         keyboard = [
@@ -1077,6 +1255,83 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except:
                 pass
 
+# ------------------------------------------------------------
+#  РУССКИЕ КОМАНДЫ (один regex + таблица диспетчеризации)
+# ------------------------------------------------------------
+RUSSIAN_COMMANDS = {
+    'старт': start_command,
+    'помощь': help_command,
+    'категории': categories_command,
+    'предложения': feedback_command,
+    'отзывы': feedbacks_command,
+    'статистика': stats_command,
+    'экспорт': export_command,
+    'подписаться': subscribe_command,
+    'отписаться': unsubscribe_command,
+    'рассылка': broadcast_command,
+    'сохранить': save_command,
+    'что_могу': what_can_i_do,
+    'админ': admin_panel,
+    'статус': status_command,
+}
+if MEME_MODULE_AVAILABLE:
+    RUSSIAN_COMMANDS.update({
+        'мем': meme_command,
+        'мемподписка': meme_subscribe_command,
+        'мемотписка': meme_unsubscribe_command,
+    })
+
+# Команда целиком (с необязательным @имя_бота), чтобы /мемподписка не попадала в /мем
+RUSSIAN_COMMAND_RE = re.compile(
+    r'^/(' + '|'.join(sorted(RUSSIAN_COMMANDS, key=len, reverse=True)) + r')(?:@\w+)?(?:\s|$)',
+    re.IGNORECASE
+)
+
+# Фильтры собираются один раз: дерево фильтров не пересоздаётся при повторной инициализации
+RUSSIAN_COMMAND_FILTER = filters.Regex(RUSSIAN_COMMAND_RE)
+TEXT_NOT_COMMAND = filters.TEXT & ~filters.COMMAND
+
+async def russian_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Совпадение уже найдено фильтром RUSSIAN_COMMAND_FILTER – PTB кладёт его в context.matches
+    match = context.matches[0] if context.matches else RUSSIAN_COMMAND_RE.match(update.message.text.strip())
+    if not match:
+        return
+    handler = RUSSIAN_COMMANDS.get(match.group(1).lower())
+    if handler:
+        await handler(update, context)
+
+# Синонимы команд обслуживает один CommandHandler: при разборе обновления
+# PTB проверяет меньше обработчиков. Обработчики не хранят состояния, поэтому список
+# собирается один раз при импорте и переиспользуется при повторной инициализации (/wake).
+BOT_HANDLERS = [
+    CommandHandler("start", start_command),
+    CommandHandler("help", help_command),
+    CommandHandler(("categories", "faq"), categories_command),
+    CommandHandler(("feedback", "suggestions"), feedback_command),
+    CommandHandler("feedbacks", feedbacks_command),
+    CommandHandler("stats", stats_command),
+    CommandHandler("export", export_command),
+    CommandHandler("subscribe", subscribe_command),
+    CommandHandler("unsubscribe", unsubscribe_command),
+    CommandHandler("broadcast", broadcast_command),
+    CommandHandler("whatcanido", what_can_i_do),
+    CommandHandler("save", save_command),
+    CommandHandler("status", status_command),
+    CommandHandler("cleanup", cleanup_command),
+]
+if MEME_MODULE_AVAILABLE:
+    BOT_HANDLERS += [
+        CommandHandler("mem", meme_command),
+        CommandHandler("memsub", meme_subscribe_command),
+        CommandHandler("memunsub", meme_unsubscribe_command),
+    ]
+BOT_HANDLERS += [
+    # --- Русские команды через MessageHandler ---
+    MessageHandler(RUSSIAN_COMMAND_FILTER, russian_command_handler),
+    MessageHandler(TEXT_NOT_COMMAND, handle_message),
+    CallbackQueryHandler(handle_callback_query),
+]
+
 # ------------------------------------------------------------
 #  ФОНОВАЯ ИНИЦИАЛИЗАЦИЯ
 # ------------------------------------------------------------
@@ -1085,40 +1340,73 @@ async def start_initialization():
     global _bot_initialization_task
     _bot_initialization_task = asyncio.create_task(setup_bot_background())
 
+async def _notify_admin_fallback(aid: int):
+    """Сообщает администратору о переходе в резервный режим."""
+    try:
+        await application.bot.send_message(
+            aid,
+            "⚠️ <b>Бот перешёл в резервный режим</b>\n"
+            "Supabase недоступна. Работает с резервным FAQ (15 вопросов).",
+            parse_mode='HTML'
+        )
+    except Exception as e:
+        logger.error(f"Не удалось отправить уведомление админу {aid}: {e}")
+
+async def _ensure_webhook(db_connected: bool):
+    """Проверяет и при необходимости устанавливает вебхук (без WEBHOOK_URL – снимает его)."""
+    if USE_WEBHOOK:
+        webhook_url = WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH
+        logger.info("🔄 Проверка вебхука %s (режим: %s)...", webhook_url, 'полный' if db_connected else 'резервный')
+        try:
+            # После пробуждения инстанса вебхук обычно уже установлен: один getWebhookInfo
+            # вместо setWebhook + повторной проверки. Секрет входит в путь URL,
+            # поэтому совпадение URL означает и совпадение секрета.
+            info = await application.bot.get_webhook_info()
+            if (info.url == webhook_url and info.max_connections == 40
+                    and set(info.allowed_updates or ()) == HANDLED_UPDATE_TYPES):
+                logger.info("✅ Вебхук уже установлен, повторная установка не нужна")
+            elif await application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=WEBHOOK_SECRET,
+                drop_pending_updates=True,
+                max_connections=40,
+                allowed_updates=WEBHOOK_ALLOWED_UPDATES
+            ):
+                logger.info("✅ Вебхук успешно установлен")
+            else:
+                logger.error("❌ Не удалось установить вебхук")
+        except Exception as e:
+            logger.error(f"❌ Ошибка при установке вебхука: {e}")
+    else:
+        await application.bot.delete_webhook(drop_pending_updates=True)
+        logger.warning("⚠️ WEBHOOK_URL не задан – вебхук снят, обновления от Telegram не принимаются")
+
 async def setup_bot_background():
-    global application, search_engine, bot_stats, _bot_initialized, _bot_initializing, _routes_registered, fallback_mode, _cleanup_task
+    global application, search_engine, bot_stats, _bot_initialized, _bot_initializing, _routes_registered, fallback_mode
     async with _bot_init_lock:
         if _bot_initialized or _bot_initializing:
             logger.info("ℹ️ Бот уже инициализируется или инициализирован")
             return
         _bot_initializing = True
-        logger.info("🔄 Ожидание стабилизации сети (5 сек)...")
-        await asyncio.sleep(5.0)
         db_connected = False
-        for attempt in range(20):
-            try:
-                logger.info(f"🔄 Попытка подключения к БД {attempt+1}/20...")
-                await init_db()
-                pool = await get_pool()
-                async with pool.acquire() as conn:
-                    await conn.fetchval("SELECT 1")
-                logger.info("✅ База данных подключена и готова к работе")
-                db_connected = True
-                break
-            except Exception as e:
-                logger.warning(f"⚠️ Попытка {attempt+1}/20 не удалась: {e}")
-                if attempt == 19:
-                    logger.error("❌ Не удалось подключиться к БД после 20 попыток.")
-                else:
-                    wait = min(20.0, 0.5 * (2 ** attempt))
-                    logger.warning(f"⏳ Повтор через {wait:.1f}с...")
-                    await asyncio.sleep(wait)
+        # Ожидание сети и повторы с экспоненциальной задержкой уже выполняет get_pool(),
+        # а транзиентные ошибки запросов – _execute_with_retry. Второй цикл повторов не нужен.
+        try:
+            logger.info("🔄 Подключение к БД...")
+            await init_db()
+            pool = await get_pool()
+            async with pool.acquire() as conn:
+                await conn.fetchval("SELECT 1")
+            logger.info("✅ База данных подключена и готова к работе")
+            db_connected = True
+        except Exception as e:
+            logger.error(f"❌ Не удалось подключиться к БД: {e}")
         if RENDER and EXIT_ON_DB_FAILURE and not db_connected:
             logger.critical("❌ БД недоступна на Render, EXIT_ON_DB_FAILURE=true. Завершение для перезапуска.")
             sys.exit(1)
         fallback_mode = not db_connected
         set_db_available(not fallback_mode)
-        logger.info(f"🔄 Синхронизация с database.py: fallback_mode={fallback_mode}")
+        logger.info("🔄 Синхронизация с database.py: fallback_mode=%s", fallback_mode)
         faq_data = []
         if db_connected:
             try:
@@ -1130,7 +1418,7 @@ async def setup_bot_background():
                     fallback_mode = True
                     set_db_available(False)
                 else:
-                    logger.info(f"✅ Загружено {len(faq_data)} записей FAQ из БД")
+                    logger.info("✅ Загружено %s записей FAQ из БД", len(faq_data))
                     try:
                         with open('faq_backup.json', 'w', encoding='utf-8') as f:
                             json.dump(faq_data, f, ensure_ascii=False, indent=2)
@@ -1159,15 +1447,15 @@ async def setup_bot_background():
                 fallback_mode = True
                 set_db_available(False)
             else:
-                logger.info(f"✅ Загружено {len(faq_data)} записей из бэкапа, но БД недоступна.")
+                logger.info("✅ Загружено %s записей из бэкапа, но БД недоступна.", len(faq_data))
                 fallback_mode = True
                 set_db_available(False)
         # ✅ ИНИЦИАЛИЗАЦИЯ ПОИСКОВОГО ДВИЖКА
         try:
             if SEARCH_ENGINE_AVAILABLE and SearchEngine:
                 search_engine = SearchEngine(max_cache_size=1000, faq_data=faq_data)
-                logger.info(f"✅ SearchEngine v5.6 инициализирован: {len(search_engine.faq_data)} записей")
-                logger.info(f"📊 Инвертированный индекс: {len(search_engine._inverted_index)} слов")
+                logger.info("✅ SearchEngine v5.6 инициализирован: %s записей", len(search_engine.faq_data))
+                logger.info("📊 Инвертированный индекс: %s слов", len(search_engine._inverted_index))
             elif EnhancedSearchEngine:
                 search_engine = EnhancedSearchEngine(max_cache_size=1000, faq_data=faq_data)
                 logger.info("✅ EnhancedSearchEngine инициализирован")
@@ -1179,78 +1467,29 @@ async def setup_bot_background():
             search_engine = BuiltinSearchEngine(faq_data)
         bot_stats = BotStatistics()
         logger.info("✅ Модуль статистики инициализирован")
-        builder = ApplicationBuilder().token(BOT_TOKEN).post_init(lambda app: logger.info("✅ Приложение Telegram готово"))
+        # concurrent_updates: обновления из очереди обрабатываются параллельно, а не по одному.
+        # По умолчанию HTTPXRequest держит одно соединение к Bot API – параллельные ответы
+        # выстраивались бы в очередь; пул соединений и HTTP/2 переиспользуют TLS-сессию.
+        builder = (
+            ApplicationBuilder()
+            .token(BOT_TOKEN)
+            .concurrent_updates(_CountingUpdateProcessor(MAX_CONCURRENT_UPDATES))
+            .connection_pool_size(32)
+            .pool_timeout(5.0)
+            .read_timeout(20.0)
+            .write_timeout(20.0)
+            .http_version('2')
+            .post_init(lambda app: logger.info("✅ Приложение Telegram готово"))
+        )
         application = builder.build()
+        is_primary = _acquire_primary_lock()
+        if not is_primary:
+            logger.info("ℹ️ Не основной воркер: вебхук и задачи по расписанию ведёт другой процесс")
         if MEME_MODULE_AVAILABLE:
-            await init_meme_handler(application.job_queue, admin_ids=ADMIN_IDS)
+            await init_meme_handler(application.job_queue, admin_ids=ADMIN_IDS, schedule_jobs=is_primary)
             logger.info("✅ Модуль мемов инициализирован")
-        # --- Регистрация обработчиков команд ---
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("categories", categories_command))
-        application.add_handler(CommandHandler("faq", categories_command))
-        application.add_handler(CommandHandler("feedback", feedback_command))
-        application.add_handler(CommandHandler("suggestions", feedback_command))
-        application.add_handler(CommandHandler("feedbacks", feedbacks_command))
-        application.add_handler(CommandHandler("stats", stats_command))
-        application.add_handler(CommandHandler("export", export_command))
-        application.add_handler(CommandHandler("subscribe", subscribe_command))
-        application.add_handler(CommandHandler("unsubscribe", unsubscribe_command))
-        application.add_handler(CommandHandler("broadcast", broadcast_command))
-        application.add_handler(CommandHandler("whatcanido", what_can_i_do))
-        application.add_handler(CommandHandler("save", save_command))
-        application.add_handler(CommandHandler("status", status_command))
-        application.add_handler(CommandHandler("cleanup", cleanup_command))
-        if MEME_MODULE_AVAILABLE:
-            application.add_handler(CommandHandler("mem", meme_command))
-            application.add_handler(CommandHandler("memsub", meme_subscribe_command))
-            application.add_handler(CommandHandler("memunsub", meme_unsubscribe_command))
-        # --- Русские команды через MessageHandler ---
-        async def russian_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            text = update.message.text.lower().strip()
-            if text.startswith('/старт'):
-                await start_command(update, context)
-            elif text.startswith('/помощь'):
-                await help_command(update, context)
-            elif text.startswith('/категории'):
-                await categories_command(update, context)
-            elif text.startswith('/предложения'):
-                await feedback_command(update, context)
-            elif text.startswith('/отзывы'):
-                await feedbacks_command(update, context)
-            elif text.startswith('/статистика'):
-                await stats_command(update, context)
-            elif text.startswith('/экспорт'):
-                await export_command(update, context)
-            elif text.startswith('/подписаться'):
-                await subscribe_command(update, context)
-            elif text.startswith('/отписаться'):
-                await unsubscribe_command(update, context)
-            elif text.startswith('/рассылка'):
-                await broadcast_command(update, context)
-            elif text.startswith('/сохранить'):
-                await save_command(update, context)
-            elif text.startswith('/мем'):
-                if MEME_MODULE_AVAILABLE:
-                    await meme_command(update, context)
-            elif text.startswith('/мемподписка'):
-                if MEME_MODULE_AVAILABLE:
-                    await meme_subscribe_command(update, context)
-            elif text.startswith('/мемотписка'):
-                if MEME_MODULE_AVAILABLE:
-                    await meme_unsubscribe_command(update, context)
-            elif text.startswith('/что_могу'):
-                await what_can_i_do(update, context)
-            elif text.startswith('/админ'):
-                await admin_panel(update, context)
-            elif text.startswith('/статус'):
-                await status_command(update, context)
-        application.add_handler(MessageHandler(
-            filters.Regex(r'^/(старт|помощь|категории|предложения|отзывы|статистика|экспорт|подписаться|отписаться|рассылка|сохранить|мем|мемподписка|мемотписка|что_могу|админ|статус)'),
-            russian_command_handler
-        ))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        application.add_handler(CallbackQueryHandler(handle_callback_query))
+        # --- Регистрация обработчиков (список собран при импорте) ---
+        application.add_handlers(BOT_HANDLERS)
         application.add_error_handler(error_handler)
         # --- Регистрация веб-маршрутов ---
         if not _routes_registered:
@@ -1270,55 +1509,33 @@ async def setup_bot_background():
                 MEME_MODULE_AVAILABLE=MEME_MODULE_AVAILABLE,
                 get_meme_handler=get_meme_handler,
                 is_authorized_func=lambda req: req.headers.get('X-Secret-Key') == WEBHOOK_SECRET,
-                admin_ids=ADMIN_IDS
+                admin_ids=ADMIN_IDS,
+                allowed_updates=WEBHOOK_ALLOWED_UPDATES
             )
             _routes_registered = True
             logger.info("✅ Веб-маршруты зарегистрированы")
         await application.initialize()
         await application.start()
-        if db_connected:
-            # ✅ ИСПРАВЛЕНО: сохраняем задачу в глобальную переменную _cleanup_task
-            _cleanup_task = asyncio.create_task(periodic_cleanup_tasks())
+        if db_connected and is_primary:
+            # Очистка – задача общего планировщика JobQueue, отдельный цикл не нужен
+            application.job_queue.run_repeating(
+                periodic_cleanup_job,
+                interval=CLEANUP_INTERVAL,
+                first=CLEANUP_INTERVAL,
+                name='periodic_cleanup',
+                job_kwargs={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': 600}
+            )
             logger.info("✅ Запущена периодическая очистка старых данных")
-        else:
+        elif not db_connected:
             logger.warning("⏸️ Периодическая очистка отключена (режим резервной работоспособности)")
-        if fallback_mode and ADMIN_IDS:
-            for aid in ADMIN_IDS:
-                try:
-                    await application.bot.send_message(
-                        aid,
-                        "⚠️ <b>Бот перешёл в резервный режим</b>\n"
-                        "Supabase недоступна. Работает с резервным FAQ (15 вопросов).",
-                        parse_mode='HTML'
-                    )
-                except Exception as e:
-                    logger.error(f"Не удалось отправить уведомление админу {aid}: {e}")
-        if RENDER:
-            webhook_url = WEBHOOK_URL + WEBHOOK_PATH
-            logger.info(f"🔄 Установка вебхука на {webhook_url} (режим: {'полный' if db_connected else 'резервный'})...")
-            try:
-                result = await application.bot.set_webhook(
-                    url=webhook_url,
-                    secret_token=WEBHOOK_SECRET,
-                    drop_pending_updates=True,
-                    max_connections=40
-                )
-                if result:
-                    logger.info(f"✅ Вебхук успешно установлен")
-                    info = await application.bot.get_webhook_info()
-                    if info.url == webhook_url:
-                        logger.info("✅ Вебхук подтверждён")
-                    else:
-                        logger.error(f"❌ Вебхук не совпадает: {info.url}")
-                else:
-                    logger.error("❌ Не удалось установить вебхук")
-            except Exception as e:
-                logger.error(f"❌ Ошибка при установке вебхука: {e}")
-        else:
-            await application.bot.delete_webhook(drop_pending_updates=True)
-            logger.info("✅ Режим поллинга")
+        # Уведомления админам и проверка вебхука – независимые вызовы Bot API, выполняем их параллельно
+        startup_calls = [_ensure_webhook(db_connected)] if is_primary else []
+        if fallback_mode and ADMIN_IDS and is_primary:
+            startup_calls.extend(_notify_admin_fallback(aid) for aid in ADMIN_IDS)
+        await asyncio.gather(*startup_calls)
         _bot_initialized = True
         _bot_initializing = False
+        _bot_ready.set()
         logger.info("✅✅✅ Бот полностью инициализирован и готов к работе ✅✅✅")
 
 # ------------------------------------------------------------
@@ -1326,17 +1543,10 @@ async def setup_bot_background():
 # ------------------------------------------------------------
 @app.after_serving
 async def cleanup():
-    global _bot_initialized, _bot_initialization_task, _cleanup_task
+    global _bot_initialized, _bot_initialization_task
     _bot_initialized = False
-    
-    # ✅ ИСПРАВЛЕНО: отмена задачи периодической очистки
-    if _cleanup_task and not _cleanup_task.done():
-        _cleanup_task.cancel()
-        try:
-            await _cleanup_task
-        except asyncio.CancelledError:
-            pass
-    
+    _bot_ready.clear()
+
     if _bot_initialization_task and not _bot_initialization_task.done():
         _bot_initialization_task.cancel()
         try:
@@ -1350,12 +1560,21 @@ async def cleanup():
         await application.shutdown()
     if bot_stats:
         await bot_stats.shutdown()
+    shutdown_report_executor()
     await shutdown_db()
     logger.info("✅ Завершено.")
 
 # ------------------------------------------------------------
 #  ЭНДПОИНТЫ
 # ------------------------------------------------------------
+# Постоянные JSON-ответы частых эндпоинтов сериализуются один раз при импорте
+_WAKE_OK_BODY = _json_dumps({'status': 'ok', 'awake': True})
+_WEBHOOK_QUEUED_BODY = _json_dumps({'status': 'queued'})
+_WEBHOOK_IGNORED_BODY = _json_dumps({'status': 'ignored'})
+
+def _json_response(body: bytes, status: int = 200) -> Response:
+    return Response(body, status=status, mimetype='application/json')
+
 @app.route('/wake', methods=['GET', 'POST'])
 async def wake():
     global _bot_initialization_task
@@ -1364,7 +1583,7 @@ async def wake():
         if not _bot_initialization_task or _bot_initialization_task.done():
             _bot_initialization_task = asyncio.create_task(setup_bot_background())
         return jsonify({'status': 'waking_up'}), 202
-    return jsonify({'status': 'ok', 'awake': True}), 200
+    return _json_response(_WAKE_OK_BODY)
 
 @app.route('/save', methods=['POST'])
 async def force_save():
@@ -1373,36 +1592,70 @@ async def force_save():
     logger.info("💾 Запрос /save (ничего не делает)")
     return jsonify({'status': 'saved'}), 200
 
+# Готовое тело ответа /health: пересобирается, только когда меняется одно из полей
+_health_cache: List[Any] = [None, b""]
+
 @app.route('/health', methods=['GET'])
 async def health_check():
-    return jsonify({
-        'status': 'ok' if _bot_initialized else 'initializing',
-        'fallback_mode': fallback_mode,
-        'timestamp': datetime.now().isoformat()
-    })
+    # Состояние БД берётся из фоновой проверки: запрос не ждёт SELECT 1
+    db = get_db_health()
+    key = (_bot_initialized, fallback_mode, db['ok'], db['msg'], now_iso())
+    if key != _health_cache[0]:
+        _health_cache[0] = key
+        _health_cache[1] = _json_dumps({
+            'status': 'ok' if _bot_initialized else 'initializing',
+            'fallback_mode': fallback_mode,
+            'database': 'ok' if db['ok'] else db['msg'],
+            'timestamp': key[-1]
+        })
+    return _json_response(_health_cache[1])
 
 @app.route(WEBHOOK_PATH, methods=['POST'])
 async def telegram_webhook():
-    global _bot_initialized, _bot_initializing
-    timeout = 30
-    start_time = time.time()
-    while not _bot_initialized and _bot_initializing and (time.time() - start_time) < timeout:
-        await asyncio.sleep(0.1)
+    # Секрет и размер проверяются до ожидания инициализации: чужие запросы
+    # отклоняются сразу и не занимают соединение на время старта бота
+    secret_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret_token.encode(), _WEBHOOK_SECRET_BYTES):
+        # Сам заголовок не логируется: его присылает сторона, не знающая секрета
+        logger.warning("⚠️ Неверный секретный токен вебхука (длина %s)", len(secret_token))
+        return jsonify({'error': 'Invalid secret token'}), 403
+    if request.content_length and request.content_length > MAX_WEBHOOK_BODY:
+        return jsonify({'error': 'Payload too large'}), 413
+    if not _bot_initialized and _bot_initializing:
+        try:
+            await asyncio.wait_for(_bot_ready.wait(), timeout=30)
+        except asyncio.TimeoutError:
+            pass
     if not _bot_initialized:
         logger.warning("⚠️ Получен вебхук до завершения инициализации бота")
         return jsonify({'error': 'Bot not initialized yet'}), 503
+    # Перегрузка определяется до чтения и разбора тела: лишние обновления не тратят CPU
+    processor = application.update_processor
+    if processor.pending >= MAX_PENDING_UPDATES:
+        logger.warning("⚠️ Слишком много необработанных обновлений, Telegram повторит доставку")
+        return jsonify({'error': 'Busy'}), 503
     try:
-        secret_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
-        if secret_token != WEBHOOK_SECRET:
-            logger.warning(f"Неверный секретный токен: {secret_token}")
-            return jsonify({'error': 'Invalid secret token'}), 403
-        update_data = await request.get_json()
-        # ✅ ИСПРАВЛЕНО: if not update_ → if not update_data
-        if not update_data:
+        # Тело разбирается из сырых байт, минуя JSON-провайдер Quart
+        try:
+            update_data = _json_loads(await request.get_data(cache=False))
+        except ValueError:
+            return jsonify({'error': 'Invalid JSON'}), 400
+        # Без update_id это не обновление Telegram – отсекаем до Update.de_json
+        if not isinstance(update_data, dict) or 'update_id' not in update_data:
             return jsonify({'error': 'No data'}), 400
+        if HANDLED_UPDATE_TYPES.isdisjoint(update_data):
+            return _json_response(_WEBHOOK_IGNORED_BODY)
+        # Все обработчики сообщений работают только с текстом: стикеры, фото и служебные
+        # сообщения (вход в чат и т.п.) отбрасываются без построения объекта Update
+        message = update_data.get('message') or update_data.get('edited_message')
+        if message is not None and 'text' not in message:
+            return _json_response(_WEBHOOK_IGNORED_BODY)
         update = Update.de_json(update_data, application.bot)
-        await application.process_update(update)
-        return jsonify({'status': 'ok'}), 200
+        # Telegram нужен только быстрый 200: обновление кладётся в очередь PTB, которую
+        # разбирает фоновый обработчик, запущенный application.start()
+        processor.pending += 1
+        application.update_queue.put_nowait(update)
+        return _json_response(_WEBHOOK_QUEUED_BODY)
     except Exception as e:
         logger.error(f"Ошибка обработки вебхука: {e}", exc_info=True)
         return jsonify({'error': str(e)}), 500
@@ -1412,17 +1665,39 @@ async def telegram_webhook():
 # ------------------------------------------------------------
 async def main():
     logger.info("🔄 Локальный запуск...")
+    # Обработчики сигналов вешаются на тот же цикл, в котором работают сервер и бот:
+    # asyncio.run() создаёт собственный цикл, и отдельный get_event_loop() до него
+    # порождал второй цикл, сигналы которого никто не обслуживал
+    # Сигнал только останавливает сервер; cleanup() выполняет after_serving ровно один раз,
+    # в том же цикле и до закрытия цикла asyncio.run()
+    loop = asyncio.get_running_loop()
+    shutdown_event = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda s=sig: shutdown_signal(s, shutdown_event))
+    # hypercorn нужен только при локальном запуске: на Render сервер стартует из CLI
+    from hypercorn.config import Config
+    from hypercorn.asyncio import serve
+    # Те же параметры, что и в startCommand render.yaml
     config = Config()
     config.bind = [f"0.0.0.0:{PORT}"]
-    await serve(app, config)
+    config.keep_alive_timeout = 75
+    await serve(app, config, shutdown_trigger=shutdown_event.wait)
 
-def shutdown_signal(sig):
-    logger.info(f"Получен сигнал {sig}, инициируем завершение...")
-    loop = asyncio.get_event_loop()
-    loop.create_task(cleanup())
+def shutdown_signal(sig, shutdown_event: asyncio.Event):
+    logger.info("Получен сигнал %s, инициируем завершение...", sig)
+    shutdown_event.set()
 
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    for sig in (signal.SIGTERM, signal.SIGINT):
-        loop.add_signal_handler(sig, lambda s=sig: shutdown_signal(s))
-    asyncio.run(main())
+    # На Render hypercorn из startCommand импортирует bot:app и этот блок не выполняет;
+    # прямой запуск там означает неверную конфигурацию сервиса
+    if RENDER:
+        logger.error("❌ bot.py запущен напрямую на Render – используйте startCommand из render.yaml")
+        sys.exit(1)
+    # Локально используем тот же цикл uvloop, что и hypercorn на Render (если пакет установлен).
+    # uvloop.run создаёт цикл без подмены глобальной политики (uvloop.install устарел).
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
@@ -15,6 +15,7 @@ class Config:
     
     # Паттерн для проверки формата токена бота Telegram
     TOKEN_PATTERN = r'^\d{8,11}:[A-Za-z0-9_-]{35,}$'
+    TOKEN_RE = re.compile(TOKEN_PATTERN)
     
     def __init__(self):
         """Инициализация конфигурации"""
@@ -49,7 +50,7 @@ class Config:
         possible_keys = ['TELEGRAM_BOT_TOKEN', 'BOT_TOKEN', 'BOTTOKEN']
         for key in possible_keys:
             token = os.getenv(key)
-            if token and re.match(self.TOKEN_PATTERN, token):
+            if token and self.TOKEN_RE.match(token):
                 return token
         return None
     
@@ -140,7 +141,7 @@ class Config:
             return False
         
         # Проверяем по регулярному выражению
-        return bool(re.match(self.TOKEN_PATTERN, token))
+        return bool(self.TOKEN_RE.match(token))
     
     def to_dict(self) -> dict:
         """Представление конфигурации в виде словаря (без токена)"""
@@ -6,7 +6,11 @@ import os
 import asyncio
 import asyncpg
 import logging
-from datetime import datetime, timedelta, date
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from cachetools import TTLCache
+from datetime import datetime, timedelta, timezone, date
 from typing import List, Dict, Optional, Any, Tuple, Set
 
 logger = logging.getLogger(__name__)
@@ -22,16 +26,45 @@ _pool_lock: Optional[asyncio.Lock] = None
 POOL_MIN_SIZE = 2
 POOL_MAX_SIZE = 10
 POOL_TIMEOUT = 5.0
+# Сколько секунд простаивающее соединение живёт в пуле. При слишком малом значении
+# редкие админ-запросы каждый раз платят за новое TCP+TLS+auth рукопожатие.
+POOL_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_POOL_MAX_INACTIVE_LIFETIME', '1800'))
+
+# Соединение, закреплённое за текущим запросом (см. request_connection)
+_bound_conn: ContextVar[Optional[asyncpg.Connection]] = ContextVar('_bound_conn', default=None)
 
 # Флаг доступности БД (устанавливается из bot.py)
 _db_available = True
 
+# Результат последней проверки БД для /health: проверка идёт в фоне,
+# запрос получает готовое значение. Неудача перепроверяется быстрее успеха.
+DB_PROBE_TTL_OK = 10.0
+DB_PROBE_TTL_FAIL = 2.0
+# msg – фиксированный статус ('OK', 'error', 'fallback', 'pool not ready', 'not checked')
+_db_probe: Dict[str, Any] = {'exp': 0.0, 'ok': False, 'msg': 'not checked'}
+_db_probe_task: Optional[asyncio.Task] = None
+
+# Кэш агрегатов для админ-панели и /status: серия обновлений страницы не бьёт в БД
+STATS_CACHE_TTL = 60
+_stats_cache = TTLCache(maxsize=8, ttl=STATS_CACHE_TTL)
+
 VALID_DAILY_FIELDS = {
     'messages', 'commands', 'searches', 'users_count',
     'feedback_count', 'ratings_helpful', 'ratings_unhelpful',
     'avg_response_time', 'total_response_time', 'response_count'
 }
 
+# Готовые тексты UPSERT для каждого поля daily_stats (собираются один раз при импорте)
+_DAILY_STAT_UPSERT = {
+    field: f'''
+            INSERT INTO daily_stats (date, {field})
+            VALUES ($1, $2)
+            ON CONFLICT (date)
+            DO UPDATE SET {field} = daily_stats.{field} + EXCLUDED.{field}
+        '''
+    for field in VALID_DAILY_FIELDS
+}
+
 # ------------------------------------------------------------
 #  УПРАВЛЕНИЕ ПУЛОМ
 # ------------------------------------------------------------
@@ -43,23 +76,22 @@ async def get_pool() -> asyncpg.Pool:
     if _pool is None:
         async with _pool_lock:
             if _pool is None:
-                logger.info("🔄 Ожидание полной инициализации сети Render (3 сек)...")
-                await asyncio.sleep(3.0)
-
+                # Первая попытка сразу: если сеть Render ещё не готова, ошибку
+                # подхватит цикл повторов с экспоненциальной задержкой
                 max_retries = 12
                 for attempt in range(max_retries):
                     try:
-                        logger.info(f"🔄 Попытка {attempt+1}/{max_retries} создания пула соединений...")
+                        logger.info("🔄 Попытка %s/%s создания пула соединений...", attempt+1, max_retries)
                         _pool = await asyncpg.create_pool(
                             DATABASE_URL,
                             min_size=POOL_MIN_SIZE,
                             max_size=POOL_MAX_SIZE,
                             command_timeout=POOL_TIMEOUT,
                             max_queries=50000,
-                            max_inactive_connection_lifetime=300,
+                            max_inactive_connection_lifetime=POOL_MAX_INACTIVE_LIFETIME,
                             statement_cache_size=0
                         )
-                        logger.info(f"✅ Пул соединений создан (min={POOL_MIN_SIZE}, max={POOL_MAX_SIZE})")
+                        logger.info("✅ Пул соединений создан (min=%s, max=%s)", POOL_MIN_SIZE, POOL_MAX_SIZE)
                         break
                     except (OSError, asyncpg.exceptions.PostgresError, asyncio.TimeoutError) as e:
                         error_msg = str(e)
@@ -88,12 +120,75 @@ def set_db_available(available: bool):
     """Устанавливает флаг доступности БД (вызывается из bot.py)."""
     global _db_available
     _db_available = available
-    logger.info(f"🔄 Статус БД изменён: {'доступна' if available else 'недоступна (fallback)'}")
+    logger.info("🔄 Статус БД изменён: %s", 'доступна' if available else 'недоступна (fallback)')
 
 def is_db_available() -> bool:
     """Проверяет доступность БД."""
     return _db_available
 
+@asynccontextmanager
+async def _acquire():
+    """Отдаёт закреплённое за запросом соединение, а если его нет — берёт из пула."""
+    conn = _bound_conn.get()
+    if conn is not None:
+        yield conn
+        return
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        yield conn
+
+@asynccontextmanager
+async def request_connection():
+    """
+    Закрепляет одно соединение из пула за обработчиком: все вызовы модуля внутри блока
+    используют его вместо повторных pool.acquire(). Запросы внутри блока должны идти
+    последовательно — asyncpg не допускает параллельных операций на одном соединении.
+    """
+    if not _db_available or _bound_conn.get() is not None:
+        yield
+        return
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        token = _bound_conn.set(conn)
+        try:
+            yield
+        finally:
+            _bound_conn.reset(token)
+
+async def _run_db_probe():
+    """Выполняет SELECT 1 на соединении из уже созданного пула и запоминает результат."""
+    now = time.monotonic()
+    if not _db_available or _pool is None:
+        _db_probe.update(exp=now + DB_PROBE_TTL_FAIL, ok=False,
+                         msg='fallback' if not _db_available else 'pool not ready')
+        return
+    try:
+        async with _pool.acquire(timeout=POOL_TIMEOUT) as conn:
+            await conn.fetchval("SELECT 1", timeout=POOL_TIMEOUT)
+        _db_probe.update(exp=time.monotonic() + DB_PROBE_TTL_OK, ok=True, msg='OK')
+    except Exception as e:
+        # Текст исключения asyncpg может содержать хост и пользователя: он пишется только
+        # в лог, а /health (без авторизации) получает фиксированный статус
+        logger.warning(f"⚠️ Проверка БД для /health не прошла: {e}")
+        _db_probe.update(exp=time.monotonic() + DB_PROBE_TTL_FAIL, ok=False, msg='error')
+
+def get_db_health() -> Dict[str, Any]:
+    """
+    Возвращает последний результат проверки БД без ожидания сети.
+    Если результат устарел, новая проверка запускается в фоне (не более одной одновременно).
+    """
+    global _db_probe_task
+    if time.monotonic() >= _db_probe['exp'] and (_db_probe_task is None or _db_probe_task.done()):
+        try:
+            _db_probe_task = asyncio.get_running_loop().create_task(_run_db_probe())
+        except RuntimeError:
+            pass
+    return _db_probe
+
+def invalidate_stats_cache():
+    """Сбрасывает кэш агрегатов (вызывается после массовых изменений данных)."""
+    _stats_cache.clear()
+
 # ------------------------------------------------------------
 #  УНИВЕРСАЛЬНАЯ ФУНКЦИЯ ДЛЯ ВЫПОЛНЕНИЯ ЗАПРОСОВ С ПОВТОРАМИ
 # ------------------------------------------------------------
@@ -124,10 +219,27 @@ async def _execute_with_retry(coro, max_retries=3, timeout=5.0):
 # ------------------------------------------------------------
 #  ИНИЦИАЛИЗАЦИЯ ТАБЛИЦ
 # ------------------------------------------------------------
+# Все объекты схемы, создаваемые init_db (таблицы и индексы)
+_SCHEMA_OBJECTS = [
+    'subscribers', 'messages', 'faq', 'meme_history', 'meme_subscribers',
+    'feedback', 'faq_ratings', 'daily_stats', 'response_times', 'error_log',
+    'idx_faq_norm_question', 'idx_error_log_timestamp', 'idx_feedback_created_at',
+]
+
 async def init_db():
     try:
         pool = await get_pool()
         async with pool.acquire() as conn:
+            # Быстрый путь: если вся схема уже есть, пропускаем серию CREATE ... IF NOT EXISTS
+            # Одним запросом получаем список всех отсутствующих объектов схемы
+            missing = await _execute_with_retry(conn.fetchval('''
+                SELECT COALESCE(array_agg(obj), '{}') FROM unnest($1::text[]) AS obj
+                WHERE to_regclass('public.' || obj) IS NULL
+            ''', _SCHEMA_OBJECTS))
+            if not missing:
+                logger.info("✅ Схема БД уже создана, инициализация таблиц пропущена.")
+                return
+            logger.info("🔄 Отсутствуют объекты схемы: %s", ', '.join(missing))
             await _execute_with_retry(conn.execute('''
                 CREATE TABLE IF NOT EXISTS subscribers (
                     user_id BIGINT PRIMARY KEY,
@@ -154,6 +266,10 @@ async def init_db():
                     usage_count INTEGER DEFAULT 0
                 )
             '''))
+            # Индекс для проверки дублей при массовой загрузке FAQ
+            await _execute_with_retry(conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_faq_norm_question ON faq (norm_question)
+            '''))
             await _execute_with_retry(conn.execute('''
                 CREATE TABLE IF NOT EXISTS meme_history (
                     id SERIAL PRIMARY KEY,
@@ -217,6 +333,13 @@ async def init_db():
                     user_id BIGINT
                 )
             '''))
+            # Индексы по времени – очистка старых записей идёт по индексу, а не полным сканированием
+            await _execute_with_retry(conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_error_log_timestamp ON error_log (timestamp)
+            '''))
+            await _execute_with_retry(conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedback (created_at)
+            '''))
             logger.info("✅ Таблицы в Supabase созданы или уже существуют.")
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации БД: {e}")
@@ -254,10 +377,16 @@ async def get_subscribers_batch(offset: int = 0, limit: int = 1000) -> List[int]
 async def count_subscribers() -> int:
     if not _db_available:
         return 0
+    # Панель и /status спрашивают число часто; кэш сбрасывается при изменении подписок
+    cached = _stats_cache.get('subscribers_count')
+    if cached is not None:
+        return cached
     try:
         pool = await get_pool()
         async with pool.acquire() as conn:
-            return await _execute_with_retry(conn.fetchval('SELECT COUNT(*) FROM subscribers'))
+            count = await _execute_with_retry(conn.fetchval('SELECT COUNT(*) FROM subscribers'))
+            _stats_cache['subscribers_count'] = count
+            return count
     except Exception as e:
         logger.error(f"❌ Ошибка подсчёта подписчиков: {e}")
         return 0
@@ -268,13 +397,37 @@ async def add_subscriber(user_id: int):
     try:
         pool = await get_pool()
         async with pool.acquire() as conn:
-            await _execute_with_retry(conn.execute('''
+            result = await _execute_with_retry(conn.execute('''
                 INSERT INTO subscribers (user_id) VALUES ($1)
                 ON CONFLICT (user_id) DO NOTHING
             ''', user_id))
+            # Повторная подписка (ON CONFLICT) число подписчиков не меняет – кэш остаётся
+            if result == 'INSERT 0 1':
+                _stats_cache.pop('subscribers_count', None)
     except Exception as e:
         logger.error(f"❌ Ошибка добавления подписчика: {e}")
 
+async def add_subscribers_bulk(user_ids: List[int]) -> int:
+    """Добавляет список подписчиков одним запросом на одном соединении из пула."""
+    if not _db_available or not user_ids:
+        return 0
+    try:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            result = await _execute_with_retry(conn.execute('''
+                INSERT INTO subscribers (user_id)
+                SELECT DISTINCT unnest($1::bigint[])
+                ON CONFLICT (user_id) DO NOTHING
+            ''', [int(uid) for uid in user_ids]))
+            _stats_cache.pop('subscribers_count', None)
+            try:
+                return int(result.split()[2]) if 'INSERT' in result else 0
+            except:
+                return 0
+    except Exception as e:
+        logger.error(f"❌ Ошибка массового добавления подписчиков: {e}")
+        return 0
+
 async def remove_subscriber(user_id: int):
     if not _db_available:
         return
@@ -282,6 +435,7 @@ async def remove_subscriber(user_id: int):
         pool = await get_pool()
         async with pool.acquire() as conn:
             await _execute_with_retry(conn.execute('DELETE FROM subscribers WHERE user_id = $1', user_id))
+            _stats_cache.pop('subscribers_count', None)
     except Exception as e:
         logger.error(f"❌ Ошибка удаления подписчика: {e}")
 
@@ -343,6 +497,26 @@ async def add_meme_subscriber(user_id: int) -> bool:
         logger.error(f"❌ Ошибка добавления подписчика на мемы: {e}")
         return False
 
+async def add_meme_subscribers_bulk(user_ids: List[int]) -> int:
+    """Добавляет список подписчиков на мемы одним запросом на одном соединении из пула."""
+    if not _db_available or not user_ids:
+        return 0
+    try:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            result = await _execute_with_retry(conn.execute('''
+                INSERT INTO meme_subscribers (user_id)
+                SELECT DISTINCT unnest($1::bigint[])
+                ON CONFLICT (user_id) DO NOTHING
+            ''', [int(uid) for uid in user_ids]))
+            try:
+                return int(result.split()[2]) if 'INSERT' in result else 0
+            except:
+                return 0
+    except Exception as e:
+        logger.error(f"❌ Ошибка массового добавления подписчиков на мемы: {e}")
+        return 0
+
 async def remove_meme_subscriber(user_id: int) -> bool:
     if not _db_available:
         return False
@@ -516,8 +690,7 @@ async def load_all_faq() -> List[Dict]:
     if not _db_available:
         return []
     try:
-        pool = await get_pool()
-        async with pool.acquire() as conn:
+        async with _acquire() as conn:
             rows = await _execute_with_retry(conn.fetch('''
                 SELECT id, priority, question, answer, keywords, category
                 FROM faq ORDER BY id
@@ -546,8 +719,7 @@ async def add_faq(question: str, answer: str, category: str, keywords: str = '',
     if not _db_available:
         return 0
     try:
-        pool = await get_pool()
-        async with pool.acquire() as conn:
+        async with _acquire() as conn:
             norm_question = ' '.join(question.lower().split())
             norm_keywords = ' '.join(keywords.lower().split()) if keywords else ''
             new_id = await _execute_with_retry(conn.fetchval('''
@@ -560,12 +732,54 @@ async def add_faq(question: str, answer: str, category: str, keywords: str = '',
         logger.error(f"❌ Ошибка добавления FAQ: {e}")
         return 0
 
+async def add_faq_bulk(items: List[Dict]) -> int:
+    """
+    Массовое добавление FAQ одним запросом (вместо N отдельных INSERT).
+    Вопросы, уже существующие в базе (по norm_question), пропускаются.
+    Возвращает количество реально добавленных записей.
+    """
+    if not _db_available or not items:
+        return 0
+    priorities, questions, answers, keywords_list = [], [], [], []
+    norm_keywords_list, norm_questions, categories = [], [], []
+    for item in items:
+        question = item['question']
+        keywords = item.get('keywords') or ''
+        priorities.append(int(item.get('priority', 0) or 0))
+        questions.append(question)
+        answers.append(item['answer'])
+        keywords_list.append(keywords)
+        norm_keywords_list.append(' '.join(keywords.lower().split()) if keywords else '')
+        norm_questions.append(' '.join(question.lower().split()))
+        categories.append(item.get('category') or 'Без категории')
+    try:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            result = await _execute_with_retry(conn.execute('''
+                INSERT INTO faq (priority, question, answer, keywords, norm_keywords, norm_question, category)
+                SELECT DISTINCT ON (t.norm_question)
+                       t.priority, t.question, t.answer, t.keywords, t.norm_keywords, t.norm_question, t.category
+                FROM unnest($1::int[], $2::text[], $3::text[], $4::text[], $5::text[], $6::text[], $7::text[])
+                     AS t(priority, question, answer, keywords, norm_keywords, norm_question, category)
+                WHERE NOT EXISTS (SELECT 1 FROM faq f WHERE f.norm_question = t.norm_question)
+            ''', priorities, questions, answers, keywords_list, norm_keywords_list, norm_questions, categories),
+                timeout=30.0)
+            try:
+                added = int(result.split()[2]) if 'INSERT' in result else 0
+            except:
+                added = 0
+            invalidate_stats_cache()
+            logger.info("✅ Массово добавлено %s записей FAQ из %s", added, len(items))
+            return added
+    except Exception as e:
+        logger.error(f"❌ Ошибка массового добавления FAQ: {e}")
+        return 0
+
 async def update_faq(faq_id: int, question: str, answer: str, category: str, keywords: str = '', priority: int = 0):
     if not _db_available:
         return
     try:
-        pool = await get_pool()
-        async with pool.acquire() as conn:
+        async with _acquire() as conn:
             norm_question = ' '.join(question.lower().split())
             norm_keywords = ' '.join(keywords.lower().split()) if keywords else ''
             await _execute_with_retry(conn.execute('''
@@ -586,8 +800,7 @@ async def delete_faq(faq_id: int):
     if not _db_available:
         return
     try:
-        pool = await get_pool()
-        async with pool.acquire() as conn:
+        async with _acquire() as conn:
             await _execute_with_retry(conn.execute('DELETE FROM faq WHERE id = $1', faq_id))
     except Exception as e:
         logger.error(f"❌ Ошибка удаления FAQ: {e}")
@@ -607,6 +820,25 @@ async def add_meme_history(user_id: int, meme_path: str = None):
     except Exception as e:
         logger.error(f"❌ Ошибка добавления истории мемов: {e}")
 
+async def add_meme_history_bulk(rows: List[Tuple[int, Optional[str], Optional[str]]]) -> int:
+    """
+    Массовая запись истории мемов: один executemany на одном соединении.
+    rows – кортежи (user_id, meme_path, sent_at в ISO-формате или None → NOW()).
+    """
+    if not _db_available or not rows:
+        return 0
+    try:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            await _execute_with_retry(conn.executemany('''
+                INSERT INTO meme_history (user_id, meme_path, sent_at)
+                VALUES ($1, $2, COALESCE($3::text::timestamptz, NOW()))
+            ''', rows), timeout=60.0)
+            return len(rows)
+    except Exception as e:
+        logger.error(f"❌ Ошибка массовой записи истории мемов: {e}")
+        return 0
+
 async def get_meme_count_last_24h(user_id: int) -> int:
     if not _db_available:
         return 0
@@ -677,18 +909,28 @@ async def get_rating_stats() -> Dict[str, Any]:
             'unhelpful': 0,
             'satisfaction_rate': 0,
         }
+    cached = _stats_cache.get('rating_stats')
+    if cached is not None:
+        return dict(cached)
     try:
         pool = await get_pool()
         async with pool.acquire() as conn:
-            total = await _execute_with_retry(conn.fetchval('SELECT COUNT(*) FROM faq_ratings'))
-            helpful = await _execute_with_retry(conn.fetchval('SELECT COUNT(*) FROM faq_ratings WHERE is_helpful = true'))
+            # Один проход по таблице вместо двух отдельных COUNT(*)
+            row = await _execute_with_retry(conn.fetchrow('''
+                SELECT COUNT(*) AS total,
+                       COUNT(*) FILTER (WHERE is_helpful) AS helpful
+                FROM faq_ratings
+            '''))
+            total, helpful = row['total'], row['helpful']
             unhelpful = total - helpful
-            return {
+            result = {
                 'total_ratings': total,
                 'helpful': helpful,
                 'unhelpful': unhelpful,
                 'satisfaction_rate': round(helpful / total * 100, 2) if total > 0 else 0,
             }
+            _stats_cache['rating_stats'] = result
+            return dict(result)
     except Exception as e:
         logger.error(f"❌ Ошибка получения статистики оценок: {e}")
         return {
@@ -704,12 +946,13 @@ async def get_rating_stats() -> Dict[str, Any]:
 async def log_daily_stat(date: str, field: str, increment: int = 1):
     if not _db_available:
         return
-    if field not in VALID_DAILY_FIELDS:
+    query = _DAILY_STAT_UPSERT.get(field)
+    if query is None:
         raise ValueError(f"Invalid field for daily_stats: {field}")
 
     try:
         if isinstance(date, str):
-            date_obj = datetime.strptime(date, '%Y-%m-%d').date()
+            date_obj = datetime.fromisoformat(date).date()
         else:
             date_obj = date
     except ValueError:
@@ -718,45 +961,39 @@ async def log_daily_stat(date: str, field: str, increment: int = 1):
 
     pool = await get_pool()
     async with pool.acquire() as conn:
-        query = f'''
-            INSERT INTO daily_stats (date, {field})
-            VALUES ($1, $2)
-            ON CONFLICT (date)
-            DO UPDATE SET {field} = daily_stats.{field} + EXCLUDED.{field}
-        '''
         await _execute_with_retry(conn.execute(query, date_obj, increment))
 
-async def add_response_time(response_time: float):
-    if not _db_available:
+# Сколько последних замеров времени ответа хранится в response_times
+RESPONSE_TIMES_HISTORY = 100
+
+async def add_response_times(response_times: List[float]):
+    """
+    Записывает пачку замеров времени ответа (накапливаются в памяти между сбросами статистики).
+    Вставка, обрезка истории до RESPONSE_TIMES_HISTORY записей и обновление дневного среднего –
+    один запрос на всю пачку.
+    """
+    if not _db_available or not response_times:
         return
+    # DELETE видит снимок без новых строк, поэтому из старых оставляем только недостающие до лимита
+    keep_old = max(RESPONSE_TIMES_HISTORY - len(response_times), 0)
     try:
         pool = await get_pool()
         async with pool.acquire() as conn:
-            await _execute_with_retry(conn.execute('INSERT INTO response_times (response_time) VALUES ($1)', response_time))
             await _execute_with_retry(conn.execute('''
-                DELETE FROM response_times
-                WHERE id <= (SELECT id FROM response_times ORDER BY id DESC LIMIT 1 OFFSET 100)
-            '''))
-            today = datetime.now().date()
-            row = await _execute_with_retry(conn.fetchrow('''
-                SELECT total_response_time, response_count FROM daily_stats WHERE date = $1
-            ''', today))
-            if row:
-                total = row['total_response_time'] + response_time
-                count = row['response_count'] + 1
-                avg = total / count
-                await _execute_with_retry(conn.execute('''
-                    UPDATE daily_stats SET
-                        total_response_time = $1,
-                        response_count = $2,
-                        avg_response_time = $3
-                    WHERE date = $4
-                ''', total, count, avg, today))
-            else:
-                await _execute_with_retry(conn.execute('''
-                    INSERT INTO daily_stats (date, total_response_time, response_count, avg_response_time)
-                    VALUES ($1, $2, $3, $4)
-                ''', today, response_time, 1, response_time))
+                WITH ins AS (
+                    INSERT INTO response_times (response_time) SELECT unnest($1::float8[])
+                ), trimmed AS (
+                    DELETE FROM response_times
+                    WHERE id NOT IN (SELECT id FROM response_times ORDER BY id DESC LIMIT $3)
+                )
+                INSERT INTO daily_stats (date, total_response_time, response_count, avg_response_time)
+                SELECT $2, SUM(t), COUNT(*), AVG(t) FROM unnest($1::float8[]) AS t
+                ON CONFLICT (date) DO UPDATE SET
+                    total_response_time = daily_stats.total_response_time + EXCLUDED.total_response_time,
+                    response_count = daily_stats.response_count + EXCLUDED.response_count,
+                    avg_response_time = (daily_stats.total_response_time + EXCLUDED.total_response_time)
+                                        / (daily_stats.response_count + EXCLUDED.response_count)
+            ''', response_times, datetime.now().date(), keep_old))
     except Exception as e:
         logger.error(f"❌ Ошибка добавления времени ответа: {e}")
 
@@ -791,30 +1028,34 @@ async def get_daily_stats_for_last_days(days: int = 7) -> Dict[str, Dict]:
     try:
         pool = await get_pool()
         async with pool.acquire() as conn:
+            # Ряд дат строит PostgreSQL (generate_series + LEFT JOIN): ровно `days` строк,
+            # дни без активности приходят с нулями, дата уже отформатирована на сервере
             rows = await _execute_with_retry(conn.fetch('''
-                SELECT date, messages, commands, searches, users_count,
-                       feedback_count, ratings_helpful, ratings_unhelpful,
-                       avg_response_time
-                FROM daily_stats
-                WHERE date > NOW() - INTERVAL '1 day' * $1
-                ORDER BY date
+                SELECT to_char(d, 'YYYY-MM-DD') AS date_str,
+                       COALESCE(s.messages, 0) AS messages,
+                       COALESCE(s.commands, 0) AS commands,
+                       COALESCE(s.searches, 0) AS searches,
+                       COALESCE(s.users_count, 0) AS users_count,
+                       COALESCE(s.feedback_count, 0) AS feedback,
+                       COALESCE(s.ratings_helpful, 0) AS helpful,
+                       COALESCE(s.ratings_unhelpful, 0) AS unhelpful
+                FROM generate_series(CURRENT_DATE - ($1::int - 1), CURRENT_DATE, INTERVAL '1 day') AS d
+                LEFT JOIN daily_stats s ON s.date = d::date
+                ORDER BY d
             ''', days))
-            result = {}
-            for r in rows:
-                date_str = r['date'].strftime("%Y-%m-%d")
-                result[date_str] = {
+            # Псевдонимы колонок совпадают с ключами результата – строка разбирается по именам
+            return {
+                r['date_str']: {
                     'messages': r['messages'],
                     'commands': r['commands'],
                     'searches': r['searches'],
                     'users_count': r['users_count'],
-                    'feedback': r['feedback_count'],
+                    'feedback': r['feedback'],
                     'response_times': [],
-                    'ratings': {
-                        'helpful': r['ratings_helpful'],
-                        'unhelpful': r['ratings_unhelpful']
-                    }
+                    'ratings': {'helpful': r['helpful'], 'unhelpful': r['unhelpful']}
                 }
-            return result
+                for r in rows
+            }
     except Exception as e:
         logger.error(f"❌ Ошибка получения дневной статистики: {e}")
         return {}
@@ -822,67 +1063,123 @@ async def get_daily_stats_for_last_days(days: int = 7) -> Dict[str, Dict]:
 # ------------------------------------------------------------
 #  ФУНКЦИИ ОЧИСТКИ СТАРЫХ ДАННЫХ
 # ------------------------------------------------------------
-async def cleanup_old_errors(days: int = 30) -> int:
-    if not _db_available:
-        return 0
-    try:
-        pool = await get_pool()
-        async with pool.acquire() as conn:
-            result = await _execute_with_retry(conn.execute('''
-                DELETE FROM error_log
-                WHERE timestamp < NOW() - INTERVAL '1 day' * $1
-            ''', days))
-            try:
-                cleaned = int(result.split()[1]) if 'DELETE' in result else 0
-            except:
-                cleaned = 0
-            logger.info(f"✅ Очищено {cleaned} старых записей из error_log")
-            return cleaned
-    except Exception as e:
-        logger.error(f"❌ Ошибка очистки error_log: {e}")
-        return 0
+# Размер пачки при очистке: короткие транзакции не держат блокировки и не раздувают WAL
+CLEANUP_BATCH_SIZE = 5000
 
-async def cleanup_old_feedback(days: int = 90) -> int:
+async def cleanup_old_data(errors_days: int = 30, feedback_days: int = 90) -> Tuple[int, int]:
+    """
+    Очищает error_log и feedback одним запросом (writable CTE) на пачку.
+    Удаление идёт пачками по первичному ключу (не больше CLEANUP_BATCH_SIZE строк на таблицу
+    за запрос), каждая пачка – отдельная транзакция.
+    Возвращает (удалено ошибок, удалено отзывов).
+    """
     if not _db_available:
-        return 0
+        return 0, 0
+    errors_cleaned = feedback_cleaned = 0
+    # Границы вычисляются один раз и передаются готовым timestamptz: все пачки удаляют
+    # по одной и той же отсечке, а условие остаётся простым диапазоном по индексу
+    now = datetime.now(timezone.utc)
+    errors_cutoff = now - timedelta(days=errors_days)
+    feedback_cutoff = now - timedelta(days=feedback_days)
     try:
         pool = await get_pool()
         async with pool.acquire() as conn:
-            result = await _execute_with_retry(conn.execute('''
-                DELETE FROM feedback
-                WHERE created_at < NOW() - INTERVAL '1 day' * $1
-            ''', days))
-            try:
-                cleaned = int(result.split()[1]) if 'DELETE' in result else 0
-            except:
-                cleaned = 0
-            logger.info(f"✅ Очищено {cleaned} старых записей из feedback")
-            return cleaned
+            while True:
+                row = await _execute_with_retry(conn.fetchrow('''
+                    WITH e AS (
+                        DELETE FROM error_log
+                        WHERE id IN (
+                            SELECT id FROM error_log
+                            WHERE timestamp < $1::timestamptz
+                            LIMIT $3
+                        )
+                        RETURNING 1
+                    ), f AS (
+                        DELETE FROM feedback
+                        WHERE id IN (
+                            SELECT id FROM feedback
+                            WHERE created_at < $2::timestamptz
+                            LIMIT $3
+                        )
+                        RETURNING 1
+                    )
+                    SELECT (SELECT COUNT(*) FROM e) AS errors,
+                           (SELECT COUNT(*) FROM f) AS feedback
+                ''', errors_cutoff, feedback_cutoff, CLEANUP_BATCH_SIZE))
+                batch_errors, batch_feedback = int(row['errors']), int(row['feedback'])
+                errors_cleaned += batch_errors
+                feedback_cleaned += batch_feedback
+                if batch_errors < CLEANUP_BATCH_SIZE and batch_feedback < CLEANUP_BATCH_SIZE:
+                    break
+            logger.info("✅ Очищено %s записей из error_log и %s из feedback", errors_cleaned, feedback_cleaned)
+            return errors_cleaned, feedback_cleaned
     except Exception as e:
-        logger.error(f"❌ Ошибка очистки feedback: {e}")
-        return 0
+        logger.error(f"❌ Ошибка очистки старых данных: {e}")
+        return errors_cleaned, feedback_cleaned
+    finally:
+        if errors_cleaned or feedback_cleaned:
+            invalidate_stats_cache()
 
 # ------------------------------------------------------------
 #  ПОДСЧЁТ ОБЩЕГО КОЛИЧЕСТВА СТРОК
 # ------------------------------------------------------------
+# Таблицы, строки которых учитываются в лимите бесплатного тарифа Supabase
+_COUNTED_TABLES = [
+    'subscribers', 'messages', 'faq', 'meme_history',
+    'meme_subscribers', 'feedback', 'faq_ratings',
+    'daily_stats', 'response_times', 'error_log'
+]
+
+def _quote_ident(name: str) -> str:
+    """Экранирует идентификатор PostgreSQL (аналог quote_ident / asyncpg.utils._quote_ident)."""
+    return '"' + name.replace('"', '""') + '"'
+
+# Один запрос вместо отдельного COUNT(*) на каждую таблицу (10 round-trip -> 1).
+# Имена таблиц нельзя передать параметрами, поэтому они экранируются и квалифицируются
+# схемой; текст запроса собирается один раз при импорте и не меняется между вызовами.
+_TOTAL_ROWS_QUERY = 'SELECT ' + ' + '.join(
+    f'(SELECT COUNT(*) FROM public.{_quote_ident(table)})' for table in _COUNTED_TABLES
+)
+
+# Лимит строк бесплатного тарифа Supabase
+ROWS_LIMIT = 20000
+
 async def get_total_rows_count() -> int:
+    """
+    Общее число строк во всех таблицах бота.
+    Сначала берётся счётчик живых строк из pg_stat_user_tables.n_live_tup: сервер ведёт его
+    сам после каждой транзакции, поэтому чтение – это готовый агрегат без сканирования таблиц
+    (в отличие от pg_class.reltuples, который обновляется только VACUUM/ANALYZE).
+    Точный COUNT(*) выполняется, если таблица не найдена в статистике, если оценка
+    приближается к лимиту – тогда важна точность, – или если счётчикам нельзя верить:
+    после сброса статистики или аварийного перезапуска n_live_tup обнуляется, и таблица
+    с нулём строк, ни разу не проанализированная, неотличима от пустой.
+    """
     if not _db_available:
         return 0
+    cached = _stats_cache.get('total_rows')
+    if cached is not None:
+        return cached
     try:
         pool = await get_pool()
         async with pool.acquire() as conn:
-            tables = [
-                'subscribers', 'messages', 'faq', 'meme_history',
-                'meme_subscribers', 'feedback', 'faq_ratings',
-                'daily_stats', 'response_times', 'error_log'
-            ]
-            total = 0
-            for table in tables:
-                try:
-                    count = await _execute_with_retry(conn.fetchval(f'SELECT COUNT(*) FROM {table}'))
-                    total += count
-                except Exception as e:
-                    logger.warning(f"Не удалось подсчитать строки в {table}: {e}")
+            row = await _execute_with_retry(conn.fetchrow('''
+                SELECT COALESCE(SUM(n_live_tup), 0)::bigint AS estimate,
+                       COUNT(*) AS found,
+                       COUNT(*) FILTER (
+                           WHERE n_live_tup = 0
+                             AND last_analyze IS NULL AND last_autoanalyze IS NULL
+                       ) AS unreliable
+                FROM pg_stat_user_tables
+                WHERE schemaname = 'public' AND relname = ANY($1::text[])
+            ''', _COUNTED_TABLES))
+            estimate = int(row['estimate'])
+            if (row['found'] == len(_COUNTED_TABLES) and row['unreliable'] == 0
+                    and 0 < estimate and estimate * 2 < ROWS_LIMIT):
+                total = estimate
+            else:
+                total = int(await _execute_with_retry(conn.fetchval(_TOTAL_ROWS_QUERY)) or 0)
+            _stats_cache['total_rows'] = total
             return total
     except Exception as e:
         logger.error(f"❌ Ошибка подсчёта строк: {e}")
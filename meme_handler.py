@@ -18,6 +18,7 @@ import logging
 # Импортируем функции из database
 from database import (
     add_meme_history,
+    add_meme_history_bulk,
     get_meme_count_last_24h,
     add_meme_subscriber,
     remove_meme_subscriber,
@@ -37,9 +38,17 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Пул HTTP-соединений к источникам мемов: keep-alive и кэш DNS между запросами
+MEME_HTTP_POOL_SIZE = 10
+MEME_HTTP_KEEPALIVE = 60
+MEME_DNS_CACHE_TTL = 300
+
 # ============================================================
 #  ФИЛЬТР МАТА - УЛУЧШЕННЫЙ СПИСОК С ТОЧНОЙ ПРОВЕРКОЙ ГРАНИЦ СЛОВ
 # ============================================================
+# Всё, кроме кириллицы и пробелов (вырезается при нормализации текста)
+_NON_CYRILLIC_RE = re.compile(r'[^а-яё\s]')
+
 RUSSIAN_BAD_WORDS = {
     'хуй', 'хуи', 'хуя', 'хуе', 'хуё', 'хуёв', 'хуев', 'хую',
     'пизда', 'пиздец', 'пизд', 'пиздюк', 'пиздюки', 'пиздюли',
@@ -184,7 +193,7 @@ class MemeFetcher:
                 try:
                     meme = await self._fetch_from_source(source)
                     if meme and self.content_filter.is_safe_meme(meme):
-                        logger.info(f"✅ Получен мем из {source['name']}: {meme.get('title', 'Без названия')[:50]}")
+                        logger.info("✅ Получен мем из %s: %s", source['name'], meme.get('title', 'Без названия')[:50])
                         self._cache['cached_meme'] = meme
                         self._cache_ttl['cached_meme'] = now + timedelta(minutes=5)
                         return meme
@@ -259,7 +268,7 @@ class ContentFilter:
         text = text.lower()
         for lat, cyr in replacements.items():
             text = text.replace(lat, cyr)
-        text = re.sub(r'[^а-яё\s]', '', text)
+        text = _NON_CYRILLIC_RE.sub('', text)
         return text
 
     @staticmethod
@@ -307,15 +316,23 @@ class MemeHandler:
 
     def set_admin_ids(self, admin_ids: List[int]):
         self.admin_ids = set(admin_ids)
-        logger.info(f"👑 Администраторы мемов: {admin_ids}")
+        logger.info("👑 Администраторы мемов: %s", admin_ids)
 
     def set_job_queue(self, job_queue: JobQueue):
         self.job_queue = job_queue
         logger.info("✅ JobQueue установлен для рассылки мемов")
 
     def get_fetcher(self) -> MemeFetcher:
+        # Общая только сессия с пулом соединений; fetcher создаётся на каждый вызов,
+        # чтобы его 5-минутный кэш мема не раздавал всем пользователям один и тот же мем
         if self.session is None or self.session.closed:
-            self.session = aiohttp.ClientSession()
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=MEME_HTTP_POOL_SIZE,
+                    keepalive_timeout=MEME_HTTP_KEEPALIVE,
+                    ttl_dns_cache=MEME_DNS_CACHE_TTL,
+                )
+            )
         return MemeFetcher(self.session)
 
     async def close_session(self):
@@ -332,7 +349,7 @@ class MemeHandler:
                          f"Свежие русские мемы можно посмотреть здесь: {channel}",
                     parse_mode='HTML'
                 )
-                logger.info(f"🔄 Отправлена ссылка на резервный канал {channel}")
+                logger.info("🔄 Отправлена ссылка на резервный канал %s", channel)
                 return True
             except Exception as e:
                 logger.warning(f"⚠️ Не удалось отправить ссылку на {channel}: {e}")
@@ -374,7 +391,7 @@ class MemeHandler:
                     )
                     # ЗАПИСЫВАЕМ В ИСТОРИЮ
                     await add_meme_history(user_id, meme['url'])
-                    logger.info(f"📨 Мем отправлен пользователю {user_id} (@{user.username})")
+                    logger.info("📨 Мем отправлен пользователю %s (@%s)", user_id, user.username)
                     return
                 except BadRequest as e:
                     logger.warning(f"❌ Ошибка отправки фото (битый URL): {e}. Пробуем fallback.")
@@ -427,7 +444,7 @@ class MemeHandler:
                     "Чтобы отписаться, используйте команду /memunsub или /мемотписка",
                     parse_mode='HTML'
                 )
-                logger.info(f"🔔 Пользователь {user_id} (@{user.username}) подписался на рассылку")
+                logger.info("🔔 Пользователь %s (@%s) подписался на рассылку", user_id, user.username)
         except Exception as e:
             logger.error(f"❌ Ошибка в /мемподписка: {e}", exc_info=True)
             await update.message.reply_text(
@@ -449,7 +466,7 @@ class MemeHandler:
                     "Чтобы подписаться снова, используйте команду /memsub или /мемподписка",
                     parse_mode='HTML'
                 )
-                logger.info(f"🔕 Пользователь {user_id} (@{user.username}) отписался от рассылки")
+                logger.info("🔕 Пользователь %s (@%s) отписался от рассылки", user_id, user.username)
             else:
                 await update.message.reply_text(
                     "ℹ️ Вы не подписаны на рассылку мемов.",
@@ -470,7 +487,7 @@ class MemeHandler:
                 logger.info("📭 Нет подписчиков для ежедневной рассылки мемов")
                 return
 
-            logger.info(f"📬 Начинаю рассылку мемов {len(subscribers)} подписчикам")
+            logger.info("📬 Начинаю рассылку мемов %s подписчикам", len(subscribers))
             fetcher = self.get_fetcher()
             meme = await fetcher.fetch_meme()
 
@@ -483,6 +500,7 @@ class MemeHandler:
             batch_size = 25
             for i in range(0, len(subscribers), batch_size):
                 batch = subscribers[i:i + batch_size]
+                history_rows = []
                 for user_id in batch:
                     try:
                         await context.bot.send_photo(
@@ -494,17 +512,19 @@ class MemeHandler:
                             parse_mode='HTML'
                         )
                         sent_count += 1
-                        # Записываем историю для каждого
-                        await add_meme_history(user_id, meme['url'])
+                        history_rows.append((user_id, meme['url'], None))
                         await asyncio.sleep(0.3)
                     except Exception as e:
                         logger.error(f"❌ Ошибка отправки мема пользователю {user_id}: {e}")
                         failed_count += 1
                         await asyncio.sleep(0.5)
+                # История пачки пишется одним executemany: запрос разбирается один раз,
+                # дальше передаются только параметры
+                await add_meme_history_bulk(history_rows)
                 if i + batch_size < len(subscribers):
                     await asyncio.sleep(1.0)
 
-            logger.info(f"✅ Рассылка завершена: отправлено {sent_count}, ошибок {failed_count}")
+            logger.info("✅ Рассылка завершена: отправлено %s, ошибок %s", sent_count, failed_count)
 
         except Exception as e:
             logger.error(f"❌ Критическая ошибка в ежедневной рассылке: {e}", exc_info=True)
@@ -547,7 +567,7 @@ class MemeHandler:
                 'available': available,
                 'details': details
             }
-            logger.info(f"📊 Статус источников мемов обновлён: доступно {sum(details.values())}/{len(details)}")
+            logger.info("📊 Статус источников мемов обновлён: доступно %s/%s", sum(details.values()), len(details))
         except Exception as e:
             logger.error(f"❌ Ошибка при проверке источников мемов: {e}")
             self._sources_status = {
@@ -571,7 +591,7 @@ class MemeHandler:
             first=10,
             name='sources_status_check'
         )
-        logger.info(f"⏰ Периодическая проверка источников мемов запущена (интервал {interval_hours} ч)")
+        logger.info("⏰ Периодическая проверка источников мемов запущена (интервал %s ч)", interval_hours)
 
     def get_sources_status(self) -> dict:
         return self._sources_status
@@ -595,13 +615,16 @@ def get_meme_handler() -> MemeHandler:
     return _meme_handler
 
 
-async def init_meme_handler(job_queue: JobQueue, admin_ids: Optional[List[int]] = None):
+async def init_meme_handler(job_queue: JobQueue, admin_ids: Optional[List[int]] = None,
+                            schedule_jobs: bool = True):
     handler = get_meme_handler()
     handler.set_job_queue(job_queue)
     if admin_ids:
         handler.set_admin_ids(admin_ids)
-    handler.schedule_daily_meme()
-    handler.schedule_sources_check(interval_hours=1)
+    # Ежедневная рассылка и проверка источников нужны одному процессу на сервис
+    if schedule_jobs:
+        handler.schedule_daily_meme()
+        handler.schedule_sources_check(interval_hours=1)
     await handler.update_sources_status()
     logger.info("✅ Модуль мемов инициализирован")
 
@@ -2,18 +2,20 @@
 import asyncio
 import json
 import os
+from collections import Counter
 from datetime import datetime
 
 # Импортируем все функции для работы с БД
 from database import (
     init_db,
-    add_subscriber,
+    add_subscribers_bulk,
     save_message,
-    add_faq,
-    add_meme_history,
-    add_meme_subscriber,
+    add_faq_bulk,
+    add_meme_history_bulk,
+    add_meme_subscribers_bulk,
     save_feedback,
     save_rating,
+    shutdown_db,
     DATABASE_URL
 )
 
@@ -31,9 +33,9 @@ async def migrate():
     try:
         with open('subscribers.json', 'r', encoding='utf-8') as f:
             subscribers = json.load(f)
-        for uid in subscribers:
-            await add_subscriber(uid)
-        print(f"✅ Перенесено {len(subscribers)} подписчиков на рассылку.")
+        # Одно соединение из пула и один запрос на весь список
+        added = await add_subscribers_bulk(subscribers)
+        print(f"✅ Перенесено {added} подписчиков на рассылку (в файле: {len(subscribers)}).")
     except FileNotFoundError:
         print("⚠️ subscribers.json не найден, пропускаем.")
     except Exception as e:
@@ -57,16 +59,14 @@ async def migrate():
     try:
         with open('faq.json', 'r', encoding='utf-8') as f:
             faq_list = json.load(f)
-        for item in faq_list:
-            # В faq.json есть поля: id, priority, question, answer, keywords, category
-            await add_faq(
-                question=item['question'],
-                answer=item['answer'],
-                category=item.get('category', 'Без категории'),
-                keywords=item.get('keywords', ''),
-                priority=item.get('priority', 0)
-            )
-        print(f"✅ Перенесено {len(faq_list)} записей FAQ.")
+        # В faq.json есть поля: id, priority, question, answer, keywords, category
+        # Загружаем одним запросом; уже существующие вопросы пропускаются
+        added = await add_faq_bulk(faq_list)
+        print(f"✅ Перенесено {added} записей FAQ (всего в файле: {len(faq_list)}).")
+        # Разбивка по категориям считается по уже загруженному списку — без GROUP BY к базе
+        category_stats = Counter(item.get('category') or 'Без категории' for item in faq_list).most_common()
+        for category, count in category_stats:
+            print(f"   • {category}: {count}")
     except FileNotFoundError:
         print("⚠️ faq.json не найден, пропускаем.")
     except Exception as e:
@@ -76,15 +76,20 @@ async def migrate():
     try:
         with open('meme_data.json', 'r', encoding='utf-8') as f:
             meme_data = json.load(f)
-        # Перенос истории мемов
+        # Перенос истории мемов: собираем все строки и пишем одним executemany.
+        # Путь к мему в JSON не хранился; исходное время отправки сохраняем, если оно корректно.
+        history_rows = []
         for user_id_str, timestamps in meme_data.get('meme_history', {}).items():
             user_id = int(user_id_str)
             for ts_str in timestamps:
-                # В БД сохраняем только факт получения, без пути к мему (можно улучшить)
-                await add_meme_history(user_id, '')
+                try:
+                    sent_at = datetime.fromisoformat(ts_str).isoformat()
+                except (TypeError, ValueError):
+                    sent_at = None
+                history_rows.append((user_id, '', sent_at))
+        await add_meme_history_bulk(history_rows)
         # Перенос подписчиков на мемы
-        for uid in meme_data.get('subscribers', []):
-            await add_meme_subscriber(uid)
+        await add_meme_subscribers_bulk(meme_data.get('subscribers', []))
         print(f"✅ Перенесена история мемов для {len(meme_data.get('meme_history', {}))} пользователей и {len(meme_data.get('subscribers', []))} подписчиков.")
     except FileNotFoundError:
         print("⚠️ meme_data.json не найден, пропускаем.")
@@ -95,6 +100,8 @@ async def migrate():
     #    Поэтому отзывы, которые были до миграции, потеряны. Но новые будут сохраняться.
     print("⚠️ Отзывы и оценки не были сохранены в JSON, поэтому они не переносятся.")
 
+    # Закрываем общий пул соединений, которым пользовались все шаги миграции
+    await shutdown_db()
     print("\n🎉 Миграция завершена! Проверьте данные в Supabase.")
 
 if __name__ == '__main__':
@@ -18,15 +18,20 @@ import logging
 import json
 import os
 import re
-import hashlib
 import math
+import time
 from typing import List, Optional, Tuple, Dict, Any, Set
 from dataclasses import dataclass
-from collections import OrderedDict, defaultdict
-from datetime import datetime, timedelta
+from collections import Counter, OrderedDict, defaultdict
 
 logger = logging.getLogger(__name__)
 
+# Время жизни результата в кэше поиска, секунд
+SEARCH_CACHE_TTL = 30 * 60
+
+# Всё, кроме букв, цифр и пробелов (заменяется пробелом при нормализации)
+_NON_WORD_RE = re.compile(r'[^\w\s]')
+
 # ------------------------------------------------------------
 #  ФУНКЦИЯ ЛЕВЕНШТЕЙНА С ПОРОГОМ
 # ------------------------------------------------------------
@@ -416,6 +421,13 @@ class SearchEngine:
         'инженерная служба': 'сервисные службы',
     }
 
+    # Синонимы, скомпилированные один раз при загрузке модуля (сначала длинные фразы),
+    # вместо сортировки словаря и поиска шаблонов в кэше re на каждую нормализацию
+    _SYNONYM_PATTERNS = [
+        (re.compile(r'(?<!\w)' + re.escape(phrase) + r'(?!\w)'), repl)
+        for phrase, repl in sorted(SYNONYMS.items(), key=lambda x: -len(x[0]))
+    ]
+
     # Стоп-слова
     STOP_WORDS = {
         'как', 'что', 'где', 'когда', 'почему', 'зачем', 'сколько', 'чей',
@@ -433,14 +445,18 @@ class SearchEngine:
                          иначе загружается из файла faq.json).
         """
         self.max_cache_size = max_cache_size
-        self.cache = OrderedDict()
-        self.cache_ttl = {}
+        # LRU-кэш результатов: ключ -> (момент истечения по time.monotonic(), результаты).
+        # Порядок ключей = порядок использования, самый старый вытесняется popitem(last=False).
+        self.cache: OrderedDict = OrderedDict()
         self.faq_data: List[FAQEntry] = []
         self._category_index: Dict[str, List[FAQEntry]] = defaultdict(list)
         self._inverted_index: Dict[str, Set[int]] = defaultdict(set)  # слово -> множество ID
         self._doc_count: int = 0
         self._idf_cache: Dict[str, float] = {}
         self.categories_norm: List[Tuple[str, str]] = []   # (оригинал, нормализованная)
+        # Счётчики, пересчитываемые только при перестроении индексов
+        self.total_faq: int = 0
+        self.category_counts: Dict[str, int] = {}
 
         self.stats = {
             'total_searches': 0,
@@ -452,7 +468,7 @@ class SearchEngine:
         # Загрузка данных
         if faq_data is not None:
             self._load_from_list(faq_data)
-            logger.info(f"✅ SearchEngine инициализирован переданными данными ({len(self.faq_data)} записей)")
+            logger.info("✅ SearchEngine инициализирован переданными данными (%s записей)", len(self.faq_data))
         else:
             self._load_faq()
 
@@ -474,7 +490,7 @@ class SearchEngine:
     def _load_from_json(self) -> bool:
         json_path = "faq.json"
         if not os.path.exists(json_path):
-            logger.debug(f"Файл {json_path} не найден")
+            logger.debug("Файл %s не найден", json_path)
             return False
 
         try:
@@ -526,7 +542,7 @@ class SearchEngine:
                 loaded_count += 1
 
             self.stats['loaded_from'] = f'JSON ({loaded_count} записей)'
-            logger.info(f"✅ Загружено {loaded_count} записей из {json_path}")
+            logger.info("✅ Загружено %s записей из %s", loaded_count, json_path)
             return True
         except Exception as e:
             logger.error(f"❌ Ошибка загрузки JSON: {e}")
@@ -583,7 +599,7 @@ class SearchEngine:
             loaded_count += 1
 
         self.stats['loaded_from'] = f'переданные данные ({loaded_count} записей)'
-        logger.info(f"✅ Загружено {loaded_count} записей из переданных данных")
+        logger.info("✅ Загружено %s записей из переданных данных", loaded_count)
 
     def _load_fallback(self):
         self.faq_data = [
@@ -620,13 +636,13 @@ class SearchEngine:
         self._category_index.clear()
         self._inverted_index.clear()
         self._doc_count = len(self.faq_data)
-        categories_raw = set()
+        self.total_faq = self._doc_count
+        category_counts = Counter(faq.category for faq in self.faq_data)
 
         for faq in self.faq_data:
             # Категорийный индекс (нормализованный)
             cat_lower = faq.category.lower().strip()
             self._category_index[cat_lower].append(faq)
-            categories_raw.add(faq.category)
 
             # Инвертированный индекс – храним ID, а не объекты
             words = set()
@@ -644,9 +660,10 @@ class SearchEngine:
             self._idf_cache[word] = math.log((self._doc_count + 1) / (df + 1)) + 1  # +1 для сглаживания
 
         # Нормализованные названия категорий для поиска по категории
-        self.categories_norm = [(cat, self._normalize_text(cat)) for cat in categories_raw]
+        self.category_counts = dict(category_counts)
+        self.categories_norm = [(cat, self._normalize_text(cat)) for cat in category_counts]
 
-        logger.debug(f"Инвертированный индекс содержит {len(self._inverted_index)} уникальных слов")
+        logger.debug("Инвертированный индекс содержит %s уникальных слов", len(self._inverted_index))
 
     # ------------------------------------------------------------
     #  НОРМАЛИЗАЦИЯ ТЕКСТА
@@ -660,12 +677,11 @@ class SearchEngine:
         text = text.replace('ё', 'е')
 
         # Замена синонимов (сначала длинные фразы)
-        for phrase, repl in sorted(self.SYNONYMS.items(), key=lambda x: -len(x[0])):
-            pattern = r'(?<!\w)' + re.escape(phrase) + r'(?!\w)'
-            text = re.sub(pattern, repl, text)
+        for pattern, repl in self._SYNONYM_PATTERNS:
+            text = pattern.sub(repl, text)
 
         # Удаляем все не-буквенно-цифровые символы, кроме пробелов
-        text = re.sub(r'[^\w\s]', ' ', text)
+        text = _NON_WORD_RE.sub(' ', text)
         words = text.split()
 
         # Удаляем стоп-слова и короткие слова (<=2 символов)
@@ -850,22 +866,23 @@ class SearchEngine:
         if category is None:   # только если категория не задана явно
             matched_cat = self._category_match_score(norm_query)
             if matched_cat:
-                logger.info(f"🔍 Запрос '{query}' совпал с категорией '{matched_cat}' на >=75%, показываем все вопросы категории")
+                logger.info("🔍 Запрос '%.50s' совпал с категорией '%s' на >=75%%, показываем все вопросы категории", query, matched_cat)
                 # Получаем все вопросы этой категории (до top_k)
                 return [(faq.id, faq.question, faq.answer, 100.0) for faq in self.faq_data if faq.category == matched_cat][:top_k]
         # ---------------------------------------------------------
 
-        cache_key = f"{norm_query}_{category}_{top_k}"
-        cache_key_hash = hashlib.md5(cache_key.encode()).hexdigest()[:16]
+        # Кортеж хэшируется дешевле, чем md5 от склеенной строки
+        cache_key = (norm_query, category, top_k)
 
-        # Проверка кэша (TTL 30 минут)
-        if cache_key_hash in self.cache:
-            expiry = self.cache_ttl.get(cache_key_hash)
-            if expiry and datetime.now() < expiry:
+        # Проверка кэша (TTL SEARCH_CACHE_TTL); просроченная запись удаляется сразу
+        entry = self.cache.get(cache_key)
+        if entry is not None:
+            if time.monotonic() < entry[0]:
                 self.stats['cache_hits'] += 1
                 self.stats['total_searches'] += 1
-                self.cache.move_to_end(cache_key_hash)
-                return self.cache[cache_key_hash]
+                self.cache.move_to_end(cache_key)
+                return entry[1]
+            del self.cache[cache_key]
 
         self.stats['total_searches'] += 1
         self.stats['cache_misses'] += 1
@@ -899,12 +916,9 @@ class SearchEngine:
 
         # Сохраняем в кэш
         if top_results:
-            if len(self.cache) >= self.max_cache_size:
-                oldest = next(iter(self.cache))
-                del self.cache[oldest]
-                del self.cache_ttl[oldest]
-            self.cache[cache_key_hash] = top_results
-            self.cache_ttl[cache_key_hash] = datetime.now() + timedelta(minutes=30)  # TTL 30 минут
+            self.cache[cache_key] = (time.monotonic() + SEARCH_CACHE_TTL, top_results)
+            while len(self.cache) > self.max_cache_size:
+                self.cache.popitem(last=False)
 
         return top_results
 
@@ -918,7 +932,7 @@ class SearchEngine:
         # Частичное совпадение (вхождение)
         for stored_cat, entries in self._category_index.items():
             if cat_lower in stored_cat or stored_cat in cat_lower:
-                logger.debug(f"Частичное совпадение категории: '{category}' -> '{stored_cat}'")
+                logger.debug("Частичное совпадение категории: '%s' -> '%s'", category, stored_cat)
                 return entries
 
         # Нечёткое сравнение (Левенштейн) для категорий
@@ -971,26 +985,23 @@ class SearchEngine:
             self._load_faq()
         self._build_indexes()
         self.cache.clear()
-        self.cache_ttl.clear()
         logger.info("🔄 Данные перезагружены, индексы перестроены, кэш сброшен")
 
     # ------------------------------------------------------------
     #  СТАТИСТИКА
     # ------------------------------------------------------------
     def get_stats(self) -> Dict[str, Any]:
-        categories = {}
-        for faq in self.faq_data:
-            categories[faq.category] = categories.get(faq.category, 0) + 1
+        categories = self.category_counts
 
         cache_hit_rate = 0.0
         if self.stats['total_searches'] > 0:
             cache_hit_rate = (self.stats['cache_hits'] / self.stats['total_searches']) * 100
 
         return {
-            'faq_count': len(self.faq_data),
+            'faq_count': self.total_faq,
             'categories': len(categories),
             'category_list': sorted(categories.keys()),
-            'category_counts': categories,
+            'category_counts': dict(categories),
             'inverted_index_size': len(self._inverted_index),
             'cache_size': len(self.cache),
             'max_cache_size': self.max_cache_size,
@@ -6,25 +6,55 @@
 import asyncio
 import io
 import logging
-from collections import defaultdict
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Tuple, Optional, Set
 
-from openpyxl import Workbook
-from openpyxl.styles import Font
-from openpyxl.utils import get_column_letter
-
+from utils import format_uptime, today_key, now_str
 from database import (
     log_daily_stat,
-    add_response_time,
+    add_response_times,
     log_error,
     save_rating as db_save_rating,
+    save_feedback,
+    get_rating_stats as db_get_rating_stats,
     get_recent_response_times,
     get_daily_stats_for_last_days,
 )
 
 logger = logging.getLogger(__name__)
 
+# Жёсткий предел числа пользователей в _user_last_active (защита от роста памяти)
+MAX_TRACKED_USERS = 50000
+
+# Сколько последних замеров времени ответа держим в памяти
+RESPONSE_TIMES_WINDOW = 100
+
+# Сколько секунд живёт посчитанная сводка get_summary_stats
+SUMMARY_CACHE_TTL = 5.0
+
+# Период сводки -> глубина выборки
+_PERIOD_DELTAS = {
+    'day': timedelta(days=1),
+    'week': timedelta(days=7),
+    'month': timedelta(days=30),
+    'quarter': timedelta(days=90),
+    'halfyear': timedelta(days=180),
+    'year': timedelta(days=365)
+}
+
+# Тип сообщения -> счётчик в дневном буфере
+_MSG_TYPE_FIELDS = {
+    'command': 'commands',
+    'message': 'messages',
+    'search': 'searches',
+    'feedback': 'feedback',
+    'rating_helpful': 'ratings_helpful',
+    'rating_unhelpful': 'ratings_unhelpful',
+}
+
 def _safe_async_task(coro):
     """Безопасно создаёт задачу asyncio, если цикл событий запущен."""
     try:
@@ -43,6 +73,10 @@ class BotStatistics:
 
     def __init__(self, flush_interval: int = 60, max_buffer_days: int = 7):
         self.start_time = datetime.now()
+        # Время запуска не меняется – строки для сводки и панели форматируются один раз
+        self.start_time_str = self.start_time.strftime("%Y-%m-%d %H:%M:%S")
+        self.start_time_display = self.start_time.strftime('%d.%m.%Y %H:%M')
+        self._start_monotonic = time.monotonic()
         self.flush_interval = flush_interval
         self.max_buffer_days = max_buffer_days
 
@@ -57,16 +91,27 @@ class BotStatistics:
         })
         self._users_buffer = defaultdict(set)  # дата -> set user_id (для оперативного доступа)
         self._users_count_buffer = defaultdict(int)  # дата -> кол-во уникальных пользователей (из БД)
-        self._response_times_cache = []  # последние 100 значений (для быстрого доступа)
+        # Кольцевой буфер последних замеров: старые значения вытесняются за O(1)
+        self._response_times_cache = deque(maxlen=RESPONSE_TIMES_WINDOW)
+        # Замеры, ещё не записанные в БД (уходят одной пачкой при flush)
+        self._pending_response_times: List[float] = []
 
-        # Дополнительный буфер для точного подсчёта активных за 24ч
-        self._user_last_active = {}  # user_id -> datetime последней активности
+        # Дополнительный буфер для точного подсчёта активных за 24ч.
+        # user_id -> unix-время последней активности (float вместо datetime – меньше памяти).
+        # Порядок ключей = порядок активности: первый ключ – самый давний пользователь.
+        self._user_last_active: Dict[int, float] = {}
+
+        # Сводки по периодам: period -> (time.monotonic() истечения, словарь сводки)
+        self._summary_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
 
         # Загружаем последние 7 дней из БД для инициализации буфера
         _safe_async_task(self._load_recent_stats())
 
-        # Задача для периодического сброса
-        _safe_async_task(self._start_flush_loop())
+        # Выставляется при каждом новом событии: без активности цикл сброса не просыпается
+        self._dirty = asyncio.Event()
+
+        # Задача для периодического сброса (останавливается в shutdown)
+        self._flush_task: Optional[asyncio.Task] = _safe_async_task(self._start_flush_loop())
 
     @property
     def daily_stats(self):
@@ -85,14 +130,17 @@ class BotStatistics:
                 self._daily_buffer[date]['ratings_helpful'] = data['ratings']['helpful']
                 self._daily_buffer[date]['ratings_unhelpful'] = data['ratings']['unhelpful']
                 self._users_count_buffer[date] = data['users_count']
-            logger.info(f"✅ Загружена статистика за {len(stats)} дней из БД")
+            logger.info("✅ Загружена статистика за %s дней из БД", len(stats))
         except Exception as e:
             logger.error(f"❌ Ошибка загрузки статистики из БД: {e}")
 
     async def _start_flush_loop(self):
         """Запускает цикл периодического сброса данных в БД."""
         while True:
+            # Ждём первого события после прошлого сброса, затем копим данные flush_interval секунд
+            await self._dirty.wait()
             await asyncio.sleep(self.flush_interval)
+            self._dirty.clear()
             await self.flush()
 
     async def flush(self):
@@ -113,6 +161,10 @@ class BotStatistics:
                 await log_daily_stat(date, 'users_count', len(users))
             users.clear()
 
+        if self._pending_response_times:
+            pending, self._pending_response_times = self._pending_response_times, []
+            await add_response_times(pending)
+
         cutoff = (datetime.now() - timedelta(days=self.max_buffer_days)).strftime("%Y-%m-%d")
         for date in list(self._daily_buffer.keys()):
             if date < cutoff:
@@ -124,47 +176,57 @@ class BotStatistics:
             if date < cutoff:
                 del self._users_count_buffer[date]
 
-        # Очистка старых записей из _user_last_active (старше max_buffer_days)
-        cutoff_7d = datetime.now() - timedelta(days=self.max_buffer_days)
-        old_keys = [uid for uid, last_active in self._user_last_active.items()
-                    if last_active < cutoff_7d]
+        # Очистка старых записей из _user_last_active (старше max_buffer_days).
+        # Словарь упорядочен по активности, поэтому достаточно пройти до первой свежей записи.
+        cutoff_7d = time.time() - self.max_buffer_days * 86400
+        old_keys = []
+        for uid, last_active in self._user_last_active.items():
+            if last_active >= cutoff_7d:
+                break
+            old_keys.append(uid)
         for uid in old_keys:
             del self._user_last_active[uid]
-        logger.debug(f"Очищено {len(old_keys)} старых записей из _user_last_active")
+        logger.debug("Очищено %s старых записей из _user_last_active", len(old_keys))
 
         logger.debug("Сброс статистики завершён.")
 
     # --- Методы логирования ---
     async def log_message(self, user_id: int, username: str, msg_type: str, text: str = ""):
-        now = datetime.now()
-        date_key = now.strftime("%Y-%m-%d")
-
-        # Обновляем время последней активности
-        self._user_last_active[user_id] = now
-
-        if msg_type == 'command':
-            self._daily_buffer[date_key]['commands'] += 1
-        elif msg_type == 'message':
-            self._daily_buffer[date_key]['messages'] += 1
-        elif msg_type == 'search':
-            self._daily_buffer[date_key]['searches'] += 1
-        elif msg_type == 'feedback':
-            self._daily_buffer[date_key]['feedback'] += 1
-            from database import save_feedback
+        date_key = today_key()
+
+        # Обновляем время последней активности (переставляем пользователя в конец)
+        last_active = self._user_last_active
+        last_active.pop(user_id, None)
+        last_active[user_id] = time.time()
+        if len(last_active) > MAX_TRACKED_USERS:
+            del last_active[next(iter(last_active))]
+
+        # Один поиск счётчика вместо цепочки if/elif с повторным обращением к буферу.
+        # Все обработчики выполняются в одном цикле asyncio, блокировки не нужны.
+        field = _MSG_TYPE_FIELDS.get(msg_type)
+        if field:
+            self._daily_buffer[date_key][field] += 1
+        if msg_type == 'feedback':
             await save_feedback(user_id, username, text)
-        elif msg_type == 'rating_helpful':
-            self._daily_buffer[date_key]['ratings_helpful'] += 1
-        elif msg_type == 'rating_unhelpful':
-            self._daily_buffer[date_key]['ratings_unhelpful'] += 1
 
         self._users_buffer[date_key].add(user_id)
+        self._dirty.set()
+
+    def count_event(self, msg_type: str):
+        """
+        Только увеличивает дневной счётчик события. Для второго события того же
+        обновления: активность пользователя уже учтена вызовом log_message.
+        """
+        field = _MSG_TYPE_FIELDS.get(msg_type)
+        if field:
+            self._daily_buffer[today_key()][field] += 1
+            self._dirty.set()
 
     def track_response_time(self, response_time: float):
-        """Записывает время ответа в кэш и в БД."""
+        """Записывает время ответа в кэш; в БД замеры уходят пачкой при flush."""
         self._response_times_cache.append(response_time)
-        if len(self._response_times_cache) > 100:
-            self._response_times_cache.pop(0)
-        _safe_async_task(add_response_time(response_time))
+        self._pending_response_times.append(response_time)
+        self._dirty.set()
 
     def get_avg_response_time(self) -> float:
         if not self._response_times_cache:
@@ -184,15 +246,26 @@ class BotStatistics:
         _safe_async_task(log_error(error_type, error_msg, user_id))
 
     def record_rating(self, faq_id: int, is_helpful: bool):
-        date_key = datetime.now().strftime("%Y-%m-%d")
+        date_key = today_key()
         self._daily_buffer[date_key]['ratings_helpful' if is_helpful else 'ratings_unhelpful'] += 1
+        self._dirty.set()
         _safe_async_task(db_save_rating(faq_id, 0, is_helpful))
 
     async def get_rating_stats(self) -> Dict[str, Any]:
-        from database import get_rating_stats as db_stats
-        return await db_stats()
+        return await db_get_rating_stats()
 
     def get_summary_stats(self, period: str = 'all', cache_size: int = 0) -> Dict[str, Any]:
+        # Сводку запрашивают панель, /stats и отчёты; пересчитываем её не чаще SUMMARY_CACHE_TTL
+        now_mono = time.monotonic()
+        cached = self._summary_cache.get(period)
+        if cached is None or now_mono >= cached[0]:
+            cached = (now_mono + SUMMARY_CACHE_TTL, self._compute_summary_stats(period))
+            self._summary_cache[period] = cached
+        result = dict(cached[1])
+        result['cache_size'] = cache_size
+        return result
+
+    def _compute_summary_stats(self, period: str) -> Dict[str, Any]:
         now = datetime.now()
         if period == 'all':
             total_users = sum(self._users_count_buffer.values())
@@ -204,40 +277,25 @@ class BotStatistics:
             total_ratings_unhelpful = sum(d['ratings_unhelpful'] for d in self._daily_buffer.values())
             all_response_times = self._response_times_cache
         else:
-            delta_map = {
-                'day': timedelta(days=1),
-                'week': timedelta(days=7),
-                'month': timedelta(days=30),
-                'quarter': timedelta(days=90),
-                'halfyear': timedelta(days=180),
-                'year': timedelta(days=365)
-            }
-            delta = delta_map.get(period, timedelta(days=30))
-            cutoff = (now - delta).date()
+            delta = _PERIOD_DELTAS.get(period, timedelta(days=30))
+            # Ключи буферов – строки YYYY-MM-DD: сравниваются как строки, без strptime на каждый день
+            cutoff = (now - delta).date().isoformat()
             total_users = 0
             total_messages = total_commands = total_searches = total_feedback = 0
             total_ratings_helpful = total_ratings_unhelpful = 0
 
             for date_str, users_cnt in self._users_count_buffer.items():
-                try:
-                    d = datetime.strptime(date_str, "%Y-%m-%d").date()
-                    if d >= cutoff:
-                        total_users += users_cnt
-                except:
-                    continue
+                if date_str >= cutoff:
+                    total_users += users_cnt
 
             for date_str, counts in self._daily_buffer.items():
-                try:
-                    d = datetime.strptime(date_str, "%Y-%m-%d").date()
-                    if d >= cutoff:
-                        total_messages += counts['messages']
-                        total_commands += counts['commands']
-                        total_searches += counts['searches']
-                        total_feedback += counts['feedback']
-                        total_ratings_helpful += counts['ratings_helpful']
-                        total_ratings_unhelpful += counts['ratings_unhelpful']
-                except:
-                    continue
+                if date_str >= cutoff:
+                    total_messages += counts['messages']
+                    total_commands += counts['commands']
+                    total_searches += counts['searches']
+                    total_feedback += counts['feedback']
+                    total_ratings_helpful += counts['ratings_helpful']
+                    total_ratings_unhelpful += counts['ratings_unhelpful']
 
             all_response_times = self._response_times_cache
 
@@ -245,13 +303,13 @@ class BotStatistics:
         status, color = self.get_response_time_status()
 
         # Подсчёт активных за 24 часа
-        cutoff_24h = now - timedelta(hours=24)
+        cutoff_24h = time.time() - 86400
         active_24h = sum(1 for last_active in self._user_last_active.values() if last_active >= cutoff_24h)
 
         return {
             'period': period,
-            'uptime': str(now - self.start_time),
-            'start_time': self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            'uptime': self.get_uptime(),
+            'start_time': self.start_time_str,
             'total_users': total_users,
             'active_users_24h': active_24h,
             'total_messages': total_messages,
@@ -264,10 +322,14 @@ class BotStatistics:
             'avg_response_time': avg_response_time,
             'response_time_status': status,
             'response_time_color': color,
-            'cache_size': cache_size,
+            'cache_size': 0,
             'error_count': 0
         }
 
+    def get_uptime(self) -> str:
+        """Время работы в виде строки (монотонные часы не зависят от перевода системного времени)."""
+        return format_uptime(time.monotonic() - self._start_monotonic)
+
     def get_total_users(self) -> int:
         return sum(self._users_count_buffer.values())
 
@@ -276,7 +338,7 @@ class BotStatistics:
         sorted_dates = sorted(self._daily_buffer.keys(), reverse=True)[:7]
         for date in sorted_dates:
             counts = self._daily_buffer[date]
-            users = self._users_buffer[date]
+            users = self._users_buffer.get(date, ())
             rows.append(f"""
                 <tr>
                     <td>{date}</td>
@@ -292,7 +354,14 @@ class BotStatistics:
         return ''.join(rows)
 
     async def shutdown(self):
-        """При завершении принудительно сбрасываем данные."""
+        """При завершении останавливаем периодический сброс и принудительно сбрасываем данные."""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        self._flush_task = None
         await self.flush()
 
 
@@ -303,6 +372,10 @@ def generate_feedback_report(bot_stats: BotStatistics) -> io.BytesIO:
     ВНИМАНИЕ: функция синхронная, но для получения данных из БД требуется асинхронный вызов.
     В текущей реализации возвращается заглушка. Рекомендуется переделать на асинхронную версию.
     """
+    # openpyxl нужен только для отчётов – импортируем при первом экспорте, а не при старте бота
+    from openpyxl import Workbook
+    from openpyxl.styles import Font
+
     output = io.BytesIO()
     try:
         wb = Workbook()
@@ -338,6 +411,10 @@ def generate_excel_report(bot_stats: BotStatistics, subscribers: List[int], sear
     Полный экспорт в Excel.
     Возвращает BytesIO с готовым файлом.
     """
+    from openpyxl import Workbook
+    from openpyxl.styles import Font
+    from openpyxl.utils import get_column_letter
+
     output = io.BytesIO()
     try:
         wb = Workbook()
@@ -352,7 +429,7 @@ def generate_excel_report(bot_stats: BotStatistics, subscribers: List[int], sear
         ws1['A3'] = "Показатель"; ws1['B3'] = "Значение"
         for cell in ['A3','B3']: ws1[cell].font = Font(bold=True)
         rows = [
-            ("Дата экспорта", datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+            ("Дата экспорта", now_str()),
             ("Время работы", stats.get('uptime', 'N/A')),
             ("Запущен", stats.get('start_time', 'N/A')),
             ("Всего пользователей", stats.get('total_users', 0)),
@@ -382,8 +459,9 @@ def generate_excel_report(bot_stats: BotStatistics, subscribers: List[int], sear
         ws2['A3'] = "Время"; ws2['B3'] = "Ответ (сек)"; ws2['C3'] = "Статус"
         for c in ['A3','B3','C3']: ws2[c].font = Font(bold=True)
         if bot_stats:
+            export_ts = now_str()  # точной метки нет
             for i, rt in enumerate(bot_stats._response_times_cache, 4):
-                ws2[f'A{i}'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")  # точной метки нет
+                ws2[f'A{i}'] = export_ts
                 ws2[f'B{i}'] = rt
                 t = rt
                 ws2[f'C{i}'] = "Хорошо" if t < 1 else "Нормально" if t < 3 else "Медленно"
@@ -436,7 +514,7 @@ def generate_excel_report(bot_stats: BotStatistics, subscribers: List[int], sear
             row = 4
             for uid, last_active in sorted(bot_stats._user_last_active.items(), key=lambda x: x[1], reverse=True):
                 ws4.cell(row=row, column=1, value=uid)
-                ws4.cell(row=row, column=2, value=last_active.strftime("%Y-%m-%d %H:%M:%S") if last_active else '')
+                ws4.cell(row=row, column=2, value=datetime.fromtimestamp(last_active).strftime("%Y-%m-%d %H:%M:%S") if last_active else '')
                 ws4.cell(row=row, column=3, value="Да" if uid in subs_set else "Нет")
                 row += 1
                 if row > 10000:  # Защита от слишком больших файлов
@@ -479,3 +557,22 @@ def generate_excel_report(bot_stats: BotStatistics, subscribers: List[int], sear
         wb.save(output)
         output.seek(0)
     return output
+
+
+# ---------- Выполнение отчётов в выделенном потоке ----------
+# Один долгоживущий поток: отчёты строятся по очереди и не занимают пул потоков по умолчанию
+_report_executor: Optional[ThreadPoolExecutor] = None
+
+async def run_report(func, *args):
+    """Выполняет генератор отчёта в потоке отчётов, не блокируя цикл событий."""
+    global _report_executor
+    if _report_executor is None:
+        _report_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reports')
+    return await asyncio.get_running_loop().run_in_executor(_report_executor, func, *args)
+
+def shutdown_report_executor():
+    """Останавливает поток отчётов (вызывается при завершении работы)."""
+    global _report_executor
+    if _report_executor is not None:
+        _report_executor.shutdown(wait=False, cancel_futures=True)
+        _report_executor = None
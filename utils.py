@@ -4,7 +4,9 @@
 Версия 1.1 — упрощена функция is_authorized (только заголовок X-Secret-Key)
 """
 import re
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Optional
 
 def is_greeting(text: str) -> bool:
@@ -45,6 +47,53 @@ def parse_period_argument(arg: str) -> str:
     }
     return mapping.get(arg, 'all')
 
+# Кэш ключа текущих суток: [строка 'YYYY-MM-DD', unix-время ближайшей полуночи]
+_today_cache = ["", 0.0]
+
+def today_key() -> str:
+    """
+    Возвращает текущую дату в формате YYYY-MM-DD.
+    datetime и strftime вызываются раз в сутки; в остальное время – сравнение двух float.
+    """
+    if time.time() >= _today_cache[1]:
+        now = datetime.now()
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        _today_cache[0] = now.strftime("%Y-%m-%d")
+        _today_cache[1] = midnight.timestamp()
+    return _today_cache[0]
+
+@lru_cache(maxsize=4)
+def _format_second(ts: int, fmt: str) -> str:
+    return datetime.fromtimestamp(ts).strftime(fmt)
+
+def now_str(fmt: str = "%Y-%m-%d %H:%M:%S") -> str:
+    """
+    Текущее время в формате fmt с точностью до секунды.
+    В пределах секунды повторные вызовы возвращают уже отформатированную строку.
+    """
+    return _format_second(int(time.time()), fmt)
+
+def now_iso() -> str:
+    """Текущее время в ISO-формате (YYYY-MM-DDTHH:MM:SS), кэш на секунду."""
+    return now_str("%Y-%m-%dT%H:%M:%S")
+
+# Шаблоны аптайма: индекс 0 – меньше суток, 1 – с днями
+_UPTIME_TEMPLATES = ("{1:02d}:{2:02d}:{3:02d}", "{0} д. {1:02d}:{2:02d}:{3:02d}")
+
+@lru_cache(maxsize=1)
+def _format_uptime_cached(total: int) -> str:
+    d, r = divmod(total, 86400)
+    h, r = divmod(r, 3600)
+    m, s = divmod(r, 60)
+    return _UPTIME_TEMPLATES[d > 0].format(d, h, m, s)
+
+def format_uptime(seconds: float) -> str:
+    """
+    Форматирует время работы как «Д д. ЧЧ:ММ:СС» (без микросекунд).
+    Значение меняется раз в секунду, поэтому последний результат кэшируется.
+    """
+    return _format_uptime_cached(max(int(seconds), 0))
+
 def is_authorized(request, expected_secret: str) -> bool:
     """
     Проверяет, содержит ли заголовок X-Secret-Key ожидаемый секрет.
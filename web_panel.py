@@ -7,23 +7,58 @@ import json
 import asyncio
 import logging
 import time
-from datetime import datetime
+from string import Template
 from typing import List, Dict, Any, Callable, Optional
 
-from quart import Quart, request, jsonify, render_template_string, make_response
+from quart import Quart, Response, request, jsonify, make_response
 
-from stats import generate_feedback_report, generate_excel_report
+from stats import generate_feedback_report, generate_excel_report, run_report
+from utils import today_key, now_str
 from database import (
     get_faq_by_id, add_faq, update_faq, delete_faq,
-    cleanup_old_errors, cleanup_old_feedback,
+    cleanup_old_data,
+    count_subscribers,
     load_all_faq,
-    get_total_rows_count
+    get_total_rows_count,
+    invalidate_stats_cache,
+    request_connection
 )
 
 logger = logging.getLogger(__name__)
 
+try:
+    import psutil
+    _process = psutil.Process()
+except ImportError:
+    psutil = None
+    _process = None
+
 MAX_BROADCAST_LENGTH = 4000
 
+# Время жизни отрендеренной главной страницы, секунд
+INDEX_CACHE_TTL = 5.0
+
+# Как долго переиспользуется замер памяти процесса, секунд
+SYS_SNAPSHOT_TTL = 2.0
+_sys_snapshot: Dict[str, float] = {'exp': 0.0, 'memory_mb': 0.0}
+
+
+def _memory_usage_mb() -> float:
+    """RSS процесса в МБ; psutil опрашивается не чаще раза в SYS_SNAPSHOT_TTL."""
+    now = time.monotonic()
+    if now >= _sys_snapshot['exp']:
+        try:
+            _sys_snapshot['memory_mb'] = _process.memory_info().rss / 1024 / 1024 if _process else 0.0
+        except Exception:
+            _sys_snapshot['memory_mb'] = 0.0
+        _sys_snapshot['exp'] = now + SYS_SNAPSHOT_TTL
+    return _sys_snapshot['memory_mb']
+
+# Кэширование статики браузером: стили главной страницы отдаются из static/index.css,
+# версия в ссылке меняется при изменении CSS
+STATIC_CACHE_MAX_AGE = 86400
+INDEX_CSS_VERSION = "2.18"
+
 # ============================================================================
 #  ПОЛНЫЙ HTML ДЛЯ СТРАНИЦЫ УПРАВЛЕНИЯ FAQ
 # ============================================================================
@@ -394,6 +429,113 @@ BROADCAST_PAGE_HTML = """<!DOCTYPE html>
 </html>"""
 
 
+# ============================================================================
+#  ШАБЛОН ГЛАВНОЙ СТРАНИЦЫ (собирается один раз при импорте)
+# ============================================================================
+INDEX_HTML_HEAD = """<!DOCTYPE html>
+<html lang="ru">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>HR Бот Мечел — Метрики</title>
+    <link rel="stylesheet" href="/static/index.css?v=${css_version}">
+</head>
+"""
+
+INDEX_HTML_TAIL = """    <script>
+    function refreshStats() {
+        const card = document.getElementById('limit-card');
+        card.style.opacity = '0.5';
+        fetch('/stats/rows')
+            .then(response => response.json())
+            .then(data => {
+                document.getElementById('limit-usage').textContent = data.usage;
+                const statusSpan = document.getElementById('limit-status');
+                statusSpan.textContent = data.status_text;
+                statusSpan.className = 'metric-badge ' + data.status_class;
+            })
+            .catch(error => console.error('Ошибка обновления:', error))
+            .finally(() => {
+                card.style.opacity = '1';
+            });
+    }
+    </script>
+</body>
+</html>"""
+
+INDEX_HTML_BODY = """<body>
+    <div class="container">
+        <h1>🤖 HR Бот «Мечел»</h1>
+        <div class="subtitle">Версия 2.18 · Расширенная веб-панель с мониторингом лимита</div>
+
+        <div class="grid">
+            <div class="card">
+                <h3>⚙️ Производительность</h3>
+                <div class="stat-value" id="stat-avg">${avg}с</div>
+                <p>Ср. время ответа (100 запросов)
+                    <span class="metric-badge ${perf_color}">${perf_text}</span>
+                </p>
+                <p>Кэш поиска: ${cache_size} записей</p>
+                <p>Запущен: ${start_time_str}</p>
+            </div>
+            <div class="card">
+                <h3>📊 Аудитория</h3>
+                <div class="stat-value">${total_users}</div>
+                <p>Уникальных пользователей (всего)</p>
+                <p>Активных сегодня: ${active_today}</p>
+                <p>Всего запросов: ${total_searches}</p>
+                <p>📬 Подписчиков: ${subscribers_count}</p>
+                <p>📚 Вопросов в базе: ${faq_count}</p>
+            </div>
+            <div class="card" id="limit-card">
+                <h3>📊 Лимит Supabase</h3>
+                <div class="stat-value" id="limit-usage">${limit_usage}</div>
+                <p>Строк использовано <span class="metric-badge ${limit_class}" id="limit-status">${limit_status}</span></p>
+                <p>Рекомендуется очистка при >18000 строк</p>
+                <button onclick="refreshStats()" class="btn" style="background:#6f42c1; margin-top:10px;">🔄 Обновить</button>
+            </div>
+            <div class="card">
+                <h3>🔌 Система</h3>
+                <div class="stat-value">
+                    <span class="status-${bot_status_class}" id="bot-status">${bot_status}</span>
+                </div>
+                <p>Администраторы: ${admin_count}</p>
+                <p>Память: ${memory_usage} МБ</p>
+            </div>
+        </div>
+
+        ${buttons_html}
+
+        <h2>📈 Статистика за последние 7 дней</h2>
+        <table>
+            <thead>
+                <tr>
+                    <th>Дата</th>
+                    <th>Пользователи</th>
+                    <th>Сообщения</th>
+                    <th>Команды</th>
+                    <th>Поиски</th>
+                    <th>Время ответа</th>
+                    <th>👍 Оценки</th>
+                    <th>👎 Оценки</th>
+                </tr>
+            </thead>
+            <tbody>
+                ${daily_rows}
+            </tbody>
+        </table>
+        <div class="footer">
+            Время генерации: ${render_ms} мс · 
+            ${generated_at}
+        </div>
+    </div>
+
+"""
+
+# Страница собирается один раз при импорте; на запрос – только подстановка значений
+INDEX_HTML_TEMPLATE = Template(INDEX_HTML_HEAD + INDEX_HTML_BODY + INDEX_HTML_TAIL)
+
+
 class WebServer:
     def __init__(
         self,
@@ -412,7 +554,8 @@ class WebServer:
         MEME_MODULE_AVAILABLE: bool,
         get_meme_handler: Callable,
         is_authorized_func: Callable,
-        admin_ids: List[int]
+        admin_ids: List[int],
+        allowed_updates: Optional[List[str]] = None
     ):
         self.app = app
         self.application = application
@@ -430,20 +573,59 @@ class WebServer:
         self.get_meme_handler = get_meme_handler
         self.is_authorized = is_authorized_func
         self.admin_ids = admin_ids
+        self.allowed_updates = allowed_updates
 
-        # Кэш для подсчёта строк (чтобы не дёргать БД слишком часто)
-        self._last_rows_check = 0
-        self._cached_rows_count = None
+        # Панель кнопок зависит только от секрета – собираем её один раз
+        self._buttons_html = f"""
+        <div style="display: flex; gap: 1rem; margin-bottom: 2rem; flex-wrap: wrap;">
+            <form method="POST" action="/export/excel" style="display: inline;">
+                <input type="hidden" name="token" value="{self.WEBHOOK_SECRET}">
+                <button type="submit" class="btn">📥 Экспорт в Excel</button>
+            </form>
+            <a href="/health" class="btn" style="background: #2E5C4E;">🩺 Health Check</a>
+            <form method="POST" action="/search/stats" style="display: inline;">
+                <input type="hidden" name="token" value="{self.WEBHOOK_SECRET}">
+                <button type="submit" class="btn" style="background: #5C3E6E;">🔍 Поиск Статистика</button>
+            </form>
+            <form method="POST" action="/feedback/export" style="display: inline;">
+                <input type="hidden" name="token" value="{self.WEBHOOK_SECRET}">
+                <button type="submit" class="btn" style="background: #9C27B0;">📝 Отзывы (выгрузка)</button>
+            </form>
+            <form method="POST" action="/rate/stats" style="display: inline;">
+                <input type="hidden" name="token" value="{self.WEBHOOK_SECRET}">
+                <button type="submit" class="btn" style="background: #FF9800;">⭐ Оценки</button>
+            </form>
+            <form method="POST" action="/cleanup" style="display: inline;">
+                <input type="hidden" name="token" value="{self.WEBHOOK_SECRET}">
+                <button type="submit" class="btn" style="background: #6f42c1;">🧹 Очистить старые данные</button>
+            </form>
+            <a href="/faq" class="btn" style="background: #17a2b8;">📚 Редактор FAQ</a>
+            <a href="/messages" class="btn" style="background: #28a745;">💬 Редактор сообщений</a>
+            <a href="/subscribers/api?key={self.WEBHOOK_SECRET}" class="btn" style="background: #6f42c1;">📬 Подписчики (JSON)</a>
+            <a href="/broadcast" class="btn" style="background: #fd7e14;">📨 Рассылка</a>
+            <form method="POST" action="/setwebhook" style="display: inline;">
+                <input type="hidden" name="token" value="{self.WEBHOOK_SECRET}">
+                <button type="submit" class="btn" style="background: #007bff;">🔧 Установить вебхук</button>
+            </form>
+        </div>
+        """
 
         # Для рейт-лимитинга очистки
-        self._last_cleanup_time = 0
+        self._last_cleanup_time = 0.0  # time.monotonic() последнего запуска
+
+        # Готовое тело ответа /stats/rows: (число строк, JSON) – пересобирается при смене числа
+        self._rows_body: Optional[tuple] = None
+
+        # Отрендеренная главная страница (HTML, time.monotonic() рендера)
+        self._index_html: Optional[str] = None
+        self._index_html_ts = 0.0
 
     def log_admin_action(self, request, action: Optional[str] = None):
         client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
         if action:
-            logger.info(f"Админ-действие: {action} - {request.method} {request.path} от {client_ip}")
+            logger.info("Админ-действие: %s - %s %s от %s", action, request.method, request.path, client_ip)
         else:
-            logger.info(f"Админ-доступ: {request.method} {request.path} от {client_ip}")
+            logger.info("Админ-доступ: %s %s от %s", request.method, request.path, client_ip)
 
     async def _check_token(self, request) -> bool:
         """Проверяет токен в заголовке, параметрах URL или в POST-форме."""
@@ -460,14 +642,16 @@ class WebServer:
     # ======================== Обработчики ========================
 
     # --- Страницы ---
+    # Страницы редакторов статичны (данные подгружаются через API) и не содержат
+    # Jinja-разметки: отдаём готовые строки, не компилируя шаблон на каждый запрос
     async def _faq_manager(self):
-        return await render_template_string(FAQ_MANAGER_HTML)
+        return FAQ_MANAGER_HTML
 
     async def _messages_manager(self):
-        return await render_template_string(MESSAGES_MANAGER_HTML)
+        return MESSAGES_MANAGER_HTML
 
     async def _broadcast_page(self):
-        return await render_template_string(BROADCAST_PAGE_HTML)
+        return BROADCAST_PAGE_HTML
 
     # --- API сообщений ---
     async def _messages_api_list(self):
@@ -539,13 +723,18 @@ class WebServer:
             item = await request.get_json()
             if not item.get('question') or not item.get('answer') or not item.get('category'):
                 return jsonify({'error': 'Missing required fields'}), 400
-            new_id = await add_faq(
-                question=item['question'].strip(),
-                answer=item['answer'].strip(),
-                category=item['category'].strip(),
-                keywords=item.get('keywords', '').strip(),
-                priority=0
-            )
+            # Вставка и перечитывание FAQ для резервной копии идут через одно соединение
+            async with request_connection():
+                new_id = await add_faq(
+                    question=item['question'].strip(),
+                    answer=item['answer'].strip(),
+                    category=item['category'].strip(),
+                    keywords=item.get('keywords', '').strip(),
+                    priority=0
+                )
+                # После успешного добавления обновляем локальную резервную копию
+                await self._update_faq_backup()
+
             new_item = {
                 'id': new_id,
                 'question': item['question'].strip(),
@@ -554,9 +743,6 @@ class WebServer:
                 'keywords': item.get('keywords', '').strip()
             }
 
-            # После успешного добавления обновляем локальную резервную копию
-            await self._update_faq_backup()
-
             return jsonify(new_item), 201
         except Exception as e:
             logger.error(f"Ошибка добавления FAQ: {e}")
@@ -570,17 +756,18 @@ class WebServer:
             item = await request.get_json()
             if not item.get('question') or not item.get('answer') or not item.get('category'):
                 return jsonify({'error': 'Missing required fields'}), 400
-            await update_faq(
-                faq_id=faq_id,
-                question=item['question'].strip(),
-                answer=item['answer'].strip(),
-                category=item['category'].strip(),
-                keywords=item.get('keywords', '').strip(),
-                priority=0
-            )
-
-            # После успешного обновления обновляем локальную резервную копию
-            await self._update_faq_backup()
+            async with request_connection():
+                await update_faq(
+                    faq_id=faq_id,
+                    question=item['question'].strip(),
+                    answer=item['answer'].strip(),
+                    category=item['category'].strip(),
+                    keywords=item.get('keywords', '').strip(),
+                    priority=0
+                )
+
+                # После успешного обновления обновляем локальную резервную копию
+                await self._update_faq_backup()
 
             return jsonify({'success': True}), 200
         except Exception as e:
@@ -591,15 +778,17 @@ class WebServer:
         if not await self._check_token(request):
             return jsonify({'error': 'Forbidden'}), 403
         self.log_admin_action(request, f"Удаление записи FAQ ID {faq_id}")
-        await delete_faq(faq_id)
+        async with request_connection():
+            await delete_faq(faq_id)
 
-        # После успешного удаления обновляем локальную резервную копию
-        await self._update_faq_backup()
+            # После успешного удаления обновляем локальную резервную копию
+            await self._update_faq_backup()
 
         return jsonify({'success': True}), 200
 
     async def _update_faq_backup(self):
         """Обновляет локальный файл faq_backup.json актуальными данными из БД."""
+        self._invalidate_index()
         try:
             faq_data = await load_all_faq()
             with open('faq_backup.json', 'w', encoding='utf-8') as f:
@@ -651,11 +840,20 @@ class WebServer:
             except Exception as e:
                 logger.error(f"❌ Ошибка отправки рассылки пользователю {uid}: {e}")
                 failed += 1
-        logger.info(f"✅ Фоновая рассылка завершена: отправлено {sent}, ошибок {failed}")
+        logger.info("✅ Фоновая рассылка завершена: отправлено %s, ошибок %s", sent, failed)
 
     # --- Главная страница ---
     async def _index(self):
         self.log_admin_action(request, "Просмотр главной панели")
+        # Повторные заходы в пределах INDEX_CACHE_TTL получают уже готовую страницу
+        now = time.monotonic()
+        if self._index_html is not None and now - self._index_html_ts < INDEX_CACHE_TTL:
+            return self._index_html
+        self._index_html = await self._render_index()
+        self._index_html_ts = now
+        return self._index_html
+
+    async def _render_index(self) -> str:
         start_time = time.time()
         s = self.bot_stats.get_summary_stats() if self.bot_stats else {}
         avg = s.get('avg_response_time', 0)
@@ -673,34 +871,28 @@ class WebServer:
         bot_status_class = "online" if self.application else "offline"
 
         total_users = s.get('total_users', 0)
-        today_key = datetime.now().strftime('%Y-%m-%d')
-        active_today = len(self.bot_stats.daily_stats.get(today_key, {}).get('users', [])) if self.bot_stats else 0
+        active_today = len(self.bot_stats.daily_stats.get(today_key(), {}).get('users', [])) if self.bot_stats else 0
         total_searches = s.get('total_searches', 0)
         cache_size = len(self.search_engine.cache) if self.search_engine and hasattr(self.search_engine, 'cache') else 0
         admin_count = len(self.admin_ids)
 
-        try:
-            import psutil
-            memory_usage = psutil.Process().memory_info().rss / 1024 / 1024
-        except (ImportError, Exception):
-            memory_usage = 0
-
-        start_time_str = self.bot_stats.start_time.strftime('%d.%m.%Y %H:%M') if self.bot_stats else 'N/A'
-        subscribers = await self.get_subscribers()
-        faq_count = len(self.search_engine.faq_data) if self.search_engine and hasattr(self.search_engine, 'faq_data') else 0
+        memory_usage = _memory_usage_mb()
+
+        start_time_str = self.bot_stats.start_time_display if self.bot_stats else 'N/A'
+        faq_count = getattr(self.search_engine, 'total_faq', 0) if self.search_engine else 0
         daily_rows = self.bot_stats.get_weekly_stats_html() if self.bot_stats else ""
 
-        # Получаем информацию о занятых строках в БД с кэшированием на 60 секунд и обработкой ошибок
-        try:
-            current_time = time.time()
-            if current_time - self._last_rows_check < 60 and self._cached_rows_count is not None:
-                total_rows = self._cached_rows_count
-            else:
-                total_rows = await get_total_rows_count()
-                self._cached_rows_count = total_rows
-                self._last_rows_check = current_time
-        except Exception as e:
-            logger.error(f"Ошибка подсчёта строк: {e}")
+        # Независимые запросы к БД выполняются параллельно на разных соединениях пула:
+        # страница ждёт самый медленный запрос, а не сумму round-trip.
+        # Информация о занятых строках кэшируется в database.py.
+        subscribers_count, total_rows = await asyncio.gather(
+            count_subscribers(), get_total_rows_count(), return_exceptions=True
+        )
+        if isinstance(subscribers_count, Exception):
+            logger.error(f"Ошибка подсчёта подписчиков: {subscribers_count}")
+            subscribers_count = 0
+        if isinstance(total_rows, Exception):
+            logger.error(f"Ошибка подсчёта строк: {total_rows}")
             total_rows = None  # Не падаем, показываем N/A
 
         if total_rows is not None:
@@ -719,256 +911,45 @@ class WebServer:
             limit_class = ""
             limit_status = ""
 
-        buttons_html = f"""
-        <div style="display: flex; gap: 1rem; margin-bottom: 2rem; flex-wrap: wrap;">
-            <form method="POST" action="/export/excel" style="display: inline;">
-                <input type="hidden" name="token" value="{self.WEBHOOK_SECRET}">
-                <button type="submit" class="btn">📥 Экспорт в Excel</button>
-            </form>
-            <a href="/health" class="btn" style="background: #2E5C4E;">🩺 Health Check</a>
-            <form method="POST" action="/search/stats" style="display: inline;">
-                <input type="hidden" name="token" value="{self.WEBHOOK_SECRET}">
-                <button type="submit" class="btn" style="background: #5C3E6E;">🔍 Поиск Статистика</button>
-            </form>
-            <form method="POST" action="/feedback/export" style="display: inline;">
-                <input type="hidden" name="token" value="{self.WEBHOOK_SECRET}">
-                <button type="submit" class="btn" style="background: #9C27B0;">📝 Отзывы (выгрузка)</button>
-            </form>
-            <form method="POST" action="/rate/stats" style="display: inline;">
-                <input type="hidden" name="token" value="{self.WEBHOOK_SECRET}">
-                <button type="submit" class="btn" style="background: #FF9800;">⭐ Оценки</button>
-            </form>
-            <form method="POST" action="/cleanup" style="display: inline;">
-                <input type="hidden" name="token" value="{self.WEBHOOK_SECRET}">
-                <button type="submit" class="btn" style="background: #6f42c1;">🧹 Очистить старые данные</button>
-            </form>
-            <a href="/faq" class="btn" style="background: #17a2b8;">📚 Редактор FAQ</a>
-            <a href="/messages" class="btn" style="background: #28a745;">💬 Редактор сообщений</a>
-            <a href="/subscribers/api?key={self.WEBHOOK_SECRET}" class="btn" style="background: #6f42c1;">📬 Подписчики (JSON)</a>
-            <a href="/broadcast" class="btn" style="background: #fd7e14;">📨 Рассылка</a>
-            <form method="POST" action="/setwebhook" style="display: inline;">
-                <input type="hidden" name="token" value="{self.WEBHOOK_SECRET}">
-                <button type="submit" class="btn" style="background: #007bff;">🔧 Установить вебхук</button>
-            </form>
-        </div>
-        """
-
-        html = f"""<!DOCTYPE html>
-<html lang="ru">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>HR Бот Мечел — Метрики</title>
-    <style>
-        :root {{
-            --bg-dark: #0B1C2F;
-            --bg-card: #152A3A;
-            --accent: #3E7B91;
-            --good: #4CAF50;
-            --warning: #FF9800;
-            --bad: #F44336;
-            --text-light: #E0E7F0;
-        }}
-        body {{
-            font-family: 'Inter', -apple-system, BlinkMacSystemFont, sans-serif;
-            background: var(--bg-dark);
-            color: var(--text-light);
-            margin: 0;
-            padding: 2rem;
-            line-height: 1.6;
-        }}
-        .container {{
-            max-width: 1200px;
-            margin: 0 auto;
-        }}
-        h1 {{
-            font-weight: 600;
-            font-size: 2.2rem;
-            margin-bottom: 0.5rem;
-            color: white;
-        }}
-        .subtitle {{
-            color: #A0C0D0;
-            margin-bottom: 2rem;
-            font-size: 1.1rem;
-        }}
-        .grid {{
-            display: grid;
-            grid-template-columns: repeat(auto-fit, minmax(300px, 1fr));
-            gap: 1.5rem;
-            margin-bottom: 2rem;
-        }}
-        .card {{
-            background: var(--bg-card);
-            border-radius: 16px;
-            padding: 1.5rem;
-            box-shadow: 0 8px 24px rgba(0,0,0,0.3);
-            border: 1px solid #2A4C5E;
-            transition: opacity 0.3s;
-        }}
-        .stat-value {{
-            font-size: 2.8rem;
-            font-weight: 700;
-            color: white;
-            line-height: 1.2;
-            margin-bottom: 0.5rem;
-        }}
-        .metric-badge {{
-            display: inline-block;
-            padding: 0.25rem 0.75rem;
-            border-radius: 20px;
-            font-size: 0.85rem;
-            font-weight: 600;
-            margin-left: 0.5rem;
-        }}
-        .metric-good {{ background: var(--good); color: white; }}
-        .metric-warning {{ background: var(--warning); color: black; }}
-        .metric-bad {{ background: var(--bad); color: white; }}
-        .status-online {{ color: var(--good); font-weight: 600; }}
-        .status-offline {{ color: var(--bad); font-weight: 600; }}
-        .btn {{
-            background: var(--accent);
-            color: white;
-            border: none;
-            padding: 0.8rem 1.8rem;
-            border-radius: 40px;
-            font-size: 1rem;
-            font-weight: 600;
-            cursor: pointer;
-            transition: 0.2s;
-            text-decoration: none;
-            display: inline-block;
-            margin-top: 1rem;
-        }}
-        .btn:hover {{
-            background: #4F9DB0;
-            transform: translateY(-2px);
-        }}
-        table {{
-            width: 100%;
-            border-collapse: collapse;
-            background: var(--bg-card);
-            border-radius: 12px;
-            overflow: hidden;
-        }}
-        th {{
-            background: #1E3A47;
-            padding: 0.75rem;
-            text-align: left;
-        }}
-        td {{
-            padding: 0.75rem;
-            border-bottom: 1px solid #2A4C5E;
-        }}
-        .footer {{
-            margin-top: 3rem;
-            color: #809AA8;
-            font-size: 0.9rem;
-            text-align: center;
-        }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>🤖 HR Бот «Мечел»</h1>
-        <div class="subtitle">Версия 2.18 · Расширенная веб-панель с мониторингом лимита</div>
-
-        <div class="grid">
-            <div class="card">
-                <h3>⚙️ Производительность</h3>
-                <div class="stat-value" id="stat-avg">{avg:.2f}с</div>
-                <p>Ср. время ответа (100 запросов)
-                    <span class="metric-badge {perf_color}">{perf_text}</span>
-                </p>
-                <p>Кэш поиска: {cache_size} записей</p>
-                <p>Запущен: {start_time_str}</p>
-            </div>
-            <div class="card">
-                <h3>📊 Аудитория</h3>
-                <div class="stat-value">{total_users}</div>
-                <p>Уникальных пользователей (всего)</p>
-                <p>Активных сегодня: {active_today}</p>
-                <p>Всего запросов: {total_searches}</p>
-                <p>📬 Подписчиков: {len(subscribers)}</p>
-                <p>📚 Вопросов в базе: {faq_count}</p>
-            </div>
-            <div class="card" id="limit-card">
-                <h3>📊 Лимит Supabase</h3>
-                <div class="stat-value" id="limit-usage">{limit_usage}</div>
-                <p>Строк использовано <span class="metric-badge {limit_class}" id="limit-status">{limit_status}</span></p>
-                <p>Рекомендуется очистка при >18000 строк</p>
-                <button onclick="refreshStats()" class="btn" style="background:#6f42c1; margin-top:10px;">🔄 Обновить</button>
-            </div>
-            <div class="card">
-                <h3>🔌 Система</h3>
-                <div class="stat-value">
-                    <span class="status-{bot_status_class}" id="bot-status">{bot_status}</span>
-                </div>
-                <p>Администраторы: {admin_count}</p>
-                <p>Память: {memory_usage:.1f} МБ</p>
-            </div>
-        </div>
-
-        {buttons_html}
-
-        <h2>📈 Статистика за последние 7 дней</h2>
-        <table>
-            <thead>
-                <tr>
-                    <th>Дата</th>
-                    <th>Пользователи</th>
-                    <th>Сообщения</th>
-                    <th>Команды</th>
-                    <th>Поиски</th>
-                    <th>Время ответа</th>
-                    <th>👍 Оценки</th>
-                    <th>👎 Оценки</th>
-                </tr>
-            </thead>
-            <tbody>
-                {daily_rows}
-            </tbody>
-        </table>
-        <div class="footer">
-            Время генерации: {(time.time() - start_time)*1000:.1f} мс · 
-            {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}
-        </div>
-    </div>
-
-    <script>
-    function refreshStats() {{
-        const card = document.getElementById('limit-card');
-        card.style.opacity = '0.5';
-        fetch('/stats/rows')
-            .then(response => response.json())
-            .then(data => {{
-                document.getElementById('limit-usage').textContent = data.usage;
-                const statusSpan = document.getElementById('limit-status');
-                statusSpan.textContent = data.status_text;
-                statusSpan.className = 'metric-badge ' + data.status_class;
-            }})
-            .catch(error => console.error('Ошибка обновления:', error))
-            .finally(() => {{
-                card.style.opacity = '1';
-            }});
-    }}
-    </script>
-</body>
-</html>"""
+        html = INDEX_HTML_TEMPLATE.substitute(
+            avg=f"{avg:.2f}",
+            perf_color=perf_color,
+            perf_text=perf_text,
+            cache_size=cache_size,
+            start_time_str=start_time_str,
+            total_users=total_users,
+            active_today=active_today,
+            total_searches=total_searches,
+            subscribers_count=subscribers_count,
+            faq_count=faq_count,
+            limit_usage=limit_usage,
+            limit_class=limit_class,
+            limit_status=limit_status,
+            bot_status_class=bot_status_class,
+            bot_status=bot_status,
+            admin_count=admin_count,
+            memory_usage=f"{memory_usage:.1f}",
+            buttons_html=self._buttons_html,
+            daily_rows=daily_rows,
+            render_ms=f"{(time.time() - start_time) * 1000:.1f}",
+            generated_at=now_str('%d.%m.%Y %H:%M:%S'),
+            css_version=INDEX_CSS_VERSION,
+        )
         return html
 
+    def _invalidate_index(self):
+        """Сбрасывает кэш главной страницы после изменения данных через панель."""
+        self._index_html = None
+
     # --- Новый эндпоинт для получения статистики строк ---
     async def _stats_rows(self):
         """Возвращает JSON с информацией о занятых строках в БД."""
         try:
-            # Используем кэш, чтобы не грузить БД при каждом обновлении
-            current_time = time.time()
-            if current_time - self._last_rows_check < 60 and self._cached_rows_count is not None:
-                total_rows = self._cached_rows_count
-            else:
-                total_rows = await get_total_rows_count()
-                self._cached_rows_count = total_rows
-                self._last_rows_check = current_time
+            # Результат кэшируется в database.py, поэтому частые обновления не грузят БД;
+            # пока число строк не изменилось, отдаём уже сериализованный ответ
+            total_rows = await get_total_rows_count()
+            if self._rows_body is not None and self._rows_body[0] == total_rows:
+                return Response(self._rows_body[1], mimetype='application/json')
 
             if total_rows is not None:
                 usage = f"{total_rows}/20000"
@@ -986,12 +967,14 @@ class WebServer:
                 status_class = ""
                 status_text = ""
 
-            return jsonify({
+            payload = self.app.json.dumps({
                 'usage': usage,
                 'status_class': status_class,
                 'status_text': status_text,
                 'rows': total_rows
             })
+            self._rows_body = (total_rows, payload)
+            return Response(payload, mimetype='application/json')
         except Exception as e:
             logger.error(f"Ошибка в /stats/rows: {e}")
             return jsonify({'error': 'Не удалось получить статистику'}), 500
@@ -1005,11 +988,10 @@ class WebServer:
             return jsonify({'error': 'Статистика не инициализирована'}), 503
         try:
             subscribers = await self.get_subscribers()
-            loop = asyncio.get_event_loop()
-            excel_file = await loop.run_in_executor(
-                None, generate_excel_report, self.bot_stats, subscribers, self.search_engine
+            excel_file = await run_report(
+                generate_excel_report, self.bot_stats, subscribers, self.search_engine
             )
-            filename = f'mechel_bot_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+            filename = f'mechel_bot_{now_str("%Y%m%d_%H%M%S")}.xlsx'
             response = await make_response(excel_file.getvalue())
             response.mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
             response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
@@ -1046,9 +1028,8 @@ class WebServer:
         if self.bot_stats is None:
             return jsonify({'error': 'Bot not initialized'}), 503
         try:
-            loop = asyncio.get_event_loop()
-            excel_file = await loop.run_in_executor(None, generate_feedback_report, self.bot_stats)
-            filename = f'feedbacks_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+            excel_file = await run_report(generate_feedback_report, self.bot_stats)
+            filename = f'feedbacks_{now_str("%Y%m%d_%H%M%S")}.xlsx'
             response = await make_response(excel_file.getvalue())
             response.mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
             response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
@@ -1064,7 +1045,10 @@ class WebServer:
         if self.bot_stats is None:
             return jsonify({'error': 'Bot not initialized'}), 503
         try:
-            stats = self.bot_stats.get_rating_stats()
+            # ?fresh=1 – пересчитать агрегаты в обход кэша (для отладки администратором)
+            if request.args.get('fresh') == '1':
+                invalidate_stats_cache()
+            stats = await self.bot_stats.get_rating_stats()
             return jsonify(stats)
         except Exception as e:
             logger.error(f"Ошибка получения статистики оценок: {e}")
@@ -1099,15 +1083,17 @@ class WebServer:
                 url=webhook_url,
                 secret_token=self.WEBHOOK_SECRET,
                 drop_pending_updates=True,
-                max_connections=40
+                max_connections=40,
+                allowed_updates=self.allowed_updates
             )
             if result:
-                info = await self.application.bot.get_webhook_info()
+                # Состояние известно без повторного getWebhookInfo: URL только что записан,
+                # а drop_pending_updates=True обнуляет очередь
                 return jsonify({
                     'success': True,
                     'message': 'Вебхук установлен',
-                    'url': info.url,
-                    'pending_update_count': info.pending_update_count
+                    'url': webhook_url,
+                    'pending_update_count': 0
                 })
             else:
                 return jsonify({'success': False, 'message': 'Не удалось установить вебхук'}), 500
@@ -1115,17 +1101,6 @@ class WebServer:
             logger.error(f"Ошибка установки вебхука: {e}")
             return jsonify({'error': str(e)}), 500
 
-    async def _health(self):
-        return jsonify({
-            'status': 'ok',
-            'bot': 'running' if self.application else 'stopped',
-            'users': self.bot_stats.get_total_users() if self.bot_stats else 0,
-            'uptime': str(datetime.now() - self.bot_stats.start_time) if self.bot_stats else 'N/A',
-            'avg_response': self.bot_stats.get_avg_response_time() if self.bot_stats else 0,
-            'cache_size': len(self.search_engine.cache) if self.search_engine and hasattr(self.search_engine, 'cache') else 0,
-            'faq_count': len(self.search_engine.faq_data) if self.search_engine and hasattr(self.search_engine, 'faq_data') else 0
-        })
-
     # ===== ЭНДПОИНТ ДЛЯ ОЧИСТКИ =====
     async def _cleanup_endpoint(self):
         """Эндпоинт для принудительной очистки старых данных (для экономии ресурсов Supabase)"""
@@ -1133,17 +1108,17 @@ class WebServer:
             return jsonify({'error': 'Forbidden'}), 403
 
         # Рейт-лимитинг: не чаще 1 раза в 5 минут
-        if time.time() - self._last_cleanup_time < 300:
+        now = time.monotonic()
+        if self._last_cleanup_time and now - self._last_cleanup_time < 300:
             return jsonify({'error': 'Очистка доступна не чаще 1 раза в 5 минут'}), 429
-        self._last_cleanup_time = time.time()
+        self._last_cleanup_time = now
 
         # Логируем действие с IP
         client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-        logger.info(f"🧹 Запуск очистки через веб (админ {client_ip})")
+        logger.info("🧹 Запуск очистки через веб (админ %s)", client_ip)
 
         try:
-            errors_cleaned = await cleanup_old_errors(days=30)
-            feedback_cleaned = await cleanup_old_feedback(days=90)
+            errors_cleaned, feedback_cleaned = await cleanup_old_data(errors_days=30, feedback_days=90)
 
             # Проверка типов на случай, если функции вернули не int
             if not isinstance(errors_cleaned, int):
@@ -1151,10 +1126,10 @@ class WebServer:
             if not isinstance(feedback_cleaned, int):
                 feedback_cleaned = 0
 
-            # Сбрасываем кэш, чтобы статистика обновилась
-            self._cached_rows_count = None
+            # Кэш статистики строк сбрасывает сам cleanup_old_data
+            self._invalidate_index()
 
-            logger.info(f"✅ Очистка завершена: удалено {errors_cleaned} ошибок и {feedback_cleaned} отзывов")
+            logger.info("✅ Очистка завершена: удалено %s ошибок и %s отзывов", errors_cleaned, feedback_cleaned)
             return jsonify({
                 'status': 'cleaned',
                 'errors_cleaned': errors_cleaned,
@@ -1167,6 +1142,8 @@ class WebServer:
 
     def register_routes(self):
         app = self.app
+        # Встроенный маршрут /static отдаёт файлы с ETag; добавляем Cache-Control: max-age
+        app.config['SEND_FILE_MAX_AGE_DEFAULT'] = STATIC_CACHE_MAX_AGE
         app.add_url_rule('/faq', view_func=self._faq_manager)
         app.add_url_rule('/messages', view_func=self._messages_manager)
         app.add_url_rule('/broadcast', view_func=self._broadcast_page)
@@ -1191,7 +1168,6 @@ class WebServer:
         app.add_url_rule('/stats/range', view_func=self._stats_range, methods=['GET', 'POST'])
         app.add_url_rule('/export/excel', view_func=self._export_excel, methods=['GET', 'POST'])
         app.add_url_rule('/setwebhook', view_func=self._set_webhook, methods=['GET', 'POST'])
-        app.add_url_rule('/health', view_func=self._health, methods=['GET'])
         app.add_url_rule('/cleanup', view_func=self._cleanup_endpoint, methods=['POST'])
 
         logger.info("✅ Все веб-маршруты зарегистрированы через WebServer")
@@ -1213,7 +1189,8 @@ def register_web_routes(
     MEME_MODULE_AVAILABLE: bool,
     get_meme_handler,
     is_authorized_func: Callable,
-    admin_ids: List[int]
+    admin_ids: List[int],
+    allowed_updates: Optional[List[str]] = None
 ):
     server = WebServer(
         app=app,
@@ -1231,6 +1208,7 @@ def register_web_routes(
         MEME_MODULE_AVAILABLE=MEME_MODULE_AVAILABLE,
         get_meme_handler=get_meme_handler,
         is_authorized_func=is_authorized_func,
-        admin_ids=admin_ids
+        admin_ids=admin_ids,
+        allowed_updates=allowed_updates
     )
     server.register_routes()